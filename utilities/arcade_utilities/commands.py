@@ -3,13 +3,14 @@ from __future__ import annotations
 from arcade.gui import *  # type: ignore
 import pyglet
 import arcade
+import asyncio
 import inspect
 import arcade.gui
 from arcade.types import Color
 from pyglet.event import EVENT_HANDLED, EVENT_UNHANDLED
 
-from typing import Sequence, Any, TypeVar, Callable
-from utilities.commands import StringView, Command, Converter, FlagConverter, command, get_command_list, process_commands
+from typing import Sequence, Any, TypeVar, Callable, Iterator, Awaitable, AsyncIterator
+from utilities.commands import StringView, Command, Converter, FlagConverter, PipeInput, command, get_command_index, get_command_list, process_pipeline, split_pipeline
 
 from contextlib import suppress
 
@@ -327,6 +328,8 @@ CustomInputText.register_event_type("on_summit")
 class CommandView(arcade.gui.UIView):
     history: list[str] = []
     history_index = -1
+    fuzzy: bool = False  # fall back to typo tolerant completion when nothing starts with what was typed
+    items_per_frame: int = 5  # how many items of a generator command's output are sent each frame
 
     def __init__(
         self,
@@ -339,6 +342,7 @@ class CommandView(arcade.gui.UIView):
         self.background_color = background_view.background_color or arcade.color.WHITE
 
         self.texts: dict[int, Text] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None  # runs async and offloaded commands, see run_awaitable
 
         self.default_attributes = {
             "font_name": font,
@@ -522,12 +526,96 @@ class CommandView(arcade.gui.UIView):
             self.input_area.text = ""
             if text[0] == "/":  # the prefix is /
                 try:
-                    process_commands(
+                    output = process_pipeline(
                         text[1:],
                         context=self.get_context(),
                     )
                 except Exception as e:
                     self.on_error(e)
+                else:
+                    if inspect.isawaitable(output):
+                        self.run_awaitable(output)
+                    elif inspect.isgenerator(output):
+                        self.stream_output(output)
+                    elif inspect.isasyncgen(output):
+                        self.stream_async_output(output)
+
+    def run_awaitable(self, awaitable: Awaitable):
+        """Runs what async and `run_in` commands return on a private event loop, it's stepped once per frame"""
+        loop = self._event_loop()
+        task = asyncio.ensure_future(awaitable, loop=loop)
+
+        def step(_):
+            self._step_loop()
+            if not task.done():
+                return
+
+            pyglet.clock.unschedule(step)
+            if task.cancelled():
+                return
+            if (error := task.exception()) is not None:
+                self.on_error(error)  # type: ignore
+            elif inspect.isgenerator(output := task.result()):
+                self.stream_output(output)
+            elif inspect.isasyncgen(output):
+                self.stream_async_output(output)
+
+        pyglet.clock.schedule(step)
+
+    def stream_output(self, output: Iterator):
+        """Sends `output` a few items per frame, the generator only runs as fast as the view shows what it gives"""
+        context = self.get_context()
+
+        def pump(_):
+            try:
+                for _ in range(self.items_per_frame):
+                    context.send(next(output))
+            except StopIteration:
+                pyglet.clock.unschedule(pump)
+            except Exception as e:
+                pyglet.clock.unschedule(pump)
+                self.on_error(e)
+
+        pyglet.clock.schedule(pump)
+
+    def stream_async_output(self, output: AsyncIterator):
+        """Like `stream_output` for async generators, the items are awaited on the private event loop"""
+        context = self.get_context()
+        loop = self._event_loop()
+        pending: asyncio.Future | None = None
+
+        def pump(_):
+            nonlocal pending
+            for _ in range(self.items_per_frame):
+                if pending is None:
+                    pending = asyncio.ensure_future(output.__anext__(), loop=loop)
+
+                self._step_loop()
+                if not pending.done():  # the next item isn't ready yet, try again next frame
+                    return
+
+                item, pending = pending, None
+                if item.cancelled() or isinstance(error := item.exception(), StopAsyncIteration):
+                    pyglet.clock.unschedule(pump)
+                    return
+                if error is not None:
+                    pyglet.clock.unschedule(pump)
+                    self.on_error(error)  # type: ignore
+                    return
+
+                context.send(item.result())
+
+        pyglet.clock.schedule(pump)
+
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop
+
+    def _step_loop(self):
+        # runs everything that's ready (worker results included) without blocking the frame
+        self._loop.call_soon(self._loop.stop)  # type: ignore
+        self._loop.run_forever()  # type: ignore
 
     def get_context(self) -> CommandContext:
         context = CommandContext(
@@ -684,27 +772,22 @@ class CommandView(arcade.gui.UIView):
         if text[-1] == " ":
             return -1, []
 
-        view = StringView(text.lstrip("/"))
+        view = StringView(split_pipeline(text.lstrip("/"))[-1])  # only the stage being typed matters
 
         command: Command | None = None
         last_arg = ""
-        command_list = get_command_list()
+        command_index = get_command_index()
 
         try:
             while command is None or command.children:
-                command_dict = {}
                 last_arg = view.get_next_word()
 
-                for command_obj in command_list:
-                    for name in command_obj.names:
-                        command_dict[name] = command_obj
-
-                _command: Command | None = command_dict.get(last_arg)
+                _command: Command | None = command_index.get(last_arg)
                 if _command:
                     command = _command
 
                     if command.children:  # type: ignore
-                        command_list = command.children  # type: ignore
+                        command_index = command.child_index  # type: ignore
                 else:
                     break
         except IndexError:
@@ -713,13 +796,15 @@ class CommandView(arcade.gui.UIView):
         completions = []
         pos = 0
         if command:
-            for child in command.children:
-                for name in child.names:
-                    if name.startswith(last_arg):
-                        completions.append(name)
+            completions.extend(command.child_index.get_prefixed_names(last_arg))
+            if self.fuzzy and not completions:
+                completions.extend(command.child_index.get_fuzzy_names(last_arg))
 
             with suppress(IndexError):
                 for param in command.parameters[command.pass_context:]:
+                    if param.annotation is PipeInput:
+                        continue
+
                     if param.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD):
                         last_arg = view.get_next_word()
                     elif param.kind == inspect.Parameter.KEYWORD_ONLY:
@@ -729,7 +814,7 @@ class CommandView(arcade.gui.UIView):
 
                     pos = len(last_arg)
 
-                    completions = param.get_completions(last_arg)
+                    completions = param.get_completions(last_arg, fuzzy=self.fuzzy)
                     if (inspect.isclass(param.annotation) and issubclass(param.annotation, FlagConverter)) or isinstance(param.annotation, FlagConverter):
                         flag_conv = param.annotation
                         prefix = flag_conv._prefix or " "  # type: ignore
@@ -742,9 +827,11 @@ class CommandView(arcade.gui.UIView):
                             pos = len(value)
                         else:
                             pos = len(latest_flag)
-        elif command_list:
+        elif command_index:
             pos = len(last_arg)
-            completions = [name for command in command_list for name in command.names if name.startswith(last_arg)]
+            completions = command_index.get_prefixed_names(last_arg)
+            if self.fuzzy and not completions:
+                completions = command_index.get_fuzzy_names(last_arg)
 
         return len(text) - pos, completions
 
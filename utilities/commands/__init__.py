@@ -1,7 +1,16 @@
-from .command import Command, command, add_command, remove_command, get_command_list, process_commands
-from .converter import Converter, FlagConverter, ColorConverter, convert, async_convert
+from .command import Command, command, add_command, remove_command, get_command, get_command_list, get_command_index, process_commands, process_commands_batch, process_pipeline
+from .index import CommandIndex, FuzzyIndex, PrefixIndex
+from .converter import Converter, ConverterCache, FlagConverter, ColorConverter, NumericArray, FileConverter, MappedFile, ConversionPlan, compile_annotation, convert, async_convert
 from .parameter import Parameter
 from .view import StringView
+from .pipeline import PipeInput, PipeStream, split_pipeline
+from .pools import get_thread_pool, set_thread_pool, get_process_pool, set_process_pool, warm_process_pool
+from .invocations import Invocation, get_invocations, cancel_invocation
+from .concurrency import ConcurrencyLimiter
+from .profiling import ProfileRequest, StackProfiler
+from .stats import CommandStats, Histogram, enable_stats, disable_stats, reset_stats, get_stats_snapshot, format_stats
+from .manifest import ManifestCommand, dump_manifest, load_manifest
+from .dispatcher import ShardedDispatcher
 from .errors import *
 
 try:
@@ -1,13 +1,25 @@
 from __future__ import annotations
 
+import asyncio
+import functools
 import inspect
 
-from utilities.commands.converter import async_convert, convert
+from utilities.commands.concurrency import ConcurrencyLimiter
+from utilities.commands.converter import ConversionPlan, MappedFile, compile_annotation
 from utilities.commands.errors import CommandNotFound, MissingRequiredArgument
+from utilities.commands.index import CommandIndex
+from utilities.commands.invocations import supervise
+from utilities.commands.profiling import ProfileRequest, _Capture
+from utilities.commands.stats import instrumentation
 from utilities.commands.parameter import Parameter
+from utilities.commands.pipeline import PipeInput, PipeStream, _pipe_input, split_pipeline, with_pipe_input
+from utilities.commands.pools import call_in_worker, get_process_pool, get_thread_pool, pickle_arguments
 from utilities.commands.view import StringView
-from utilities.misc import maybe_await
-from typing import Callable
+from utilities.misc import maybe_await, run_in_executor
+from concurrent.futures import Executor
+from inspect import isawaitable
+from time import perf_counter
+from typing import Any, Callable, Hashable, Iterable, Literal
 
 
 def evaluate_annotation(annotation, globals):
@@ -17,7 +29,49 @@ def evaluate_annotation(annotation, globals):
     return annotation
 
 
+def _release_arguments(invocation_plan: list[tuple[Parameter, ConversionPlan]], args: tuple, kwargs: dict) -> None:
+    # the parsed arguments line up with the plan, the context (if any) sits where the first parameter is
+    position = 0
+    for param, plan in invocation_plan:
+        if param.kind == Parameter.VAR_POSITIONAL:
+            values = args[position:]
+            position = len(args)
+        elif param.kind == Parameter.KEYWORD_ONLY or param.kind == Parameter.VAR_KEYWORD:
+            values = (kwargs.get(param.name),)
+        else:
+            values = args[position:position + 1]
+            position += 1
+
+        # a Union can give something else and defaults aren't this invocation's to close
+        if plan.releases:
+            for value in values:
+                if isinstance(value, MappedFile) and value is not param.default:
+                    value.close()
+
+
+def _release_after(generator, invocation_plan: list[tuple[Parameter, ConversionPlan]], args: tuple, kwargs: dict):
+    try:
+        return (yield from generator)
+    finally:
+        _release_arguments(invocation_plan, args, kwargs)
+
+
+async def _async_release_after(generator, invocation_plan: list[tuple[Parameter, ConversionPlan]], args: tuple, kwargs: dict):
+    try:
+        async for item in generator:
+            yield item
+    finally:
+        _release_arguments(invocation_plan, args, kwargs)
+
+
 class Command:
+    # The signature is only inspected (and string annotations evaluated) when the command is first
+    # executed or completed. Set this to True, or pass `eager=True`, to do it straight away, e.g. in tests
+    eager_inspection: bool = False
+    # seconds an async invocation (converters and callback) may take before it raises CommandTimeout, for commands
+    # without their own `timeout`. Sync commands can't be interrupted and ignore both
+    default_timeout: float | None = None
+
     def __init__(
             self,
             callback: Callable,
@@ -27,64 +81,324 @@ class Command:
             usage: str = '',
             aliases: list[str] | None = None,
             parent: Command | None = None,
-            pass_context: bool = False
+            pass_context: bool = False,
+            concurrent_conversion: bool = False,
+            run_in: Literal["thread", "process"] | None = None,
+            offload_conversion: bool = False,
+            executor: Executor | None = None,
+            timeout: float | None = None,
+            max_concurrency: int | None = None,
+            concurrency_key: Callable[[Any], Hashable] | None = None,
+            max_queue: int | None = None,
+            eager: bool | None = None
     ):
         self.names: list[str] = [name or callback.__name__] + (aliases or [])
         self.usage: str = usage
         self.description: str = description
         self.callback: Callable = callback
-        self.parameters: list[Parameter] = []
         self.pass_context = pass_context
+        self.concurrent_conversion = concurrent_conversion  # only affects async commands
+
+        # sync callbacks with `run_in="thread"` or "process" run in `executor` (or the shared pool) and execute returns an awaitable.
+        # With `offload_conversion` the arguments are converted in the worker thread as well. Process commands get their arguments
+        # (and context) pickled after conversion, the callback is looked up by module and qualname in the worker
+        if run_in not in (None, "thread", "process"):
+            raise ValueError(f"run_in must be None, 'thread' or 'process', not {run_in!r}")
+        if run_in == "process" and offload_conversion:
+            raise ValueError("offload_conversion is only supported with run_in='thread'")
+        self.run_in = run_in
+        self.offload_conversion = offload_conversion
+        self.executor = executor
+        self.timeout = timeout
+
+        # at most `max_concurrency` invocations run at once (per `concurrency_key(context)` bucket), see ConcurrencyLimiter
+        if max_concurrency is None and (concurrency_key is not None or max_queue is not None):
+            raise ValueError("concurrency_key and max_queue need max_concurrency")
+        self.limiter: ConcurrencyLimiter | None = None
+        if max_concurrency is not None:
+            self.limiter = ConcurrencyLimiter(self, max_concurrency, key=concurrency_key, max_queue=max_queue)
+
+        self.parent: Command | None = parent
+        self.child_index: CommandIndex = CommandIndex()
+
+        if inspect.iscoroutinefunction(self.callback):
+            self.execute = self.async_execute
+        elif run_in is not None:
+            self.execute = self.offloaded_execute
+        else:
+            self.execute = self.sync_execute
+        self._profile_request: ProfileRequest | None = None
+
+        if self.eager_inspection if eager is None else eager:
+            self.resolve()
 
+    def __repr__(self):
+        return f'<Command name="{self.names[0]}">'
+
+    @functools.cached_property
+    def parameters(self) -> list[Parameter]:
+        parameters = []
         for name, param in inspect.signature(self.callback).parameters.items():
 
             if isinstance(param.default, Parameter):
-                self.parameters.append(param.default)
+                parameters.append(param.default)
             else:
                 parameter = Parameter(
                     name=name,
                     kind=param.kind,
                     default=param.default,
-                    annotation=str if param.annotation is inspect.Parameter.empty else evaluate_annotation(param.annotation, callback.__globals__)
+                    annotation=str if param.annotation is inspect.Parameter.empty else evaluate_annotation(param.annotation, self.callback.__globals__)
                 )
-                self.parameters.append(parameter)
+                parameters.append(parameter)
+
+        return parameters
+
+    @functools.cached_property
+    def _invocation_plan(self) -> list[tuple[Parameter, ConversionPlan]]:
+        # resolved once so execution doesn't have to re-inspect annotations on every call.
+        # A PipeInput parameter isn't parsed, `_call` passes it in
+        invocation_plan = []
+        for param in self.parameters:
+            if param.annotation is PipeInput:
+                if param.kind != Parameter.KEYWORD_ONLY:
+                    raise TypeError(f"the PipeInput parameter {param.name!r} of {self.names[0]!r} has to be keyword only")
+                if self.run_in == "process":
+                    raise TypeError(f"{self.names[0]!r} can't take a PipeInput, a pipeline can't be sent to a worker process")
+                continue
+
+            invocation_plan.append((param, compile_annotation(param.annotation)))
+
+        return invocation_plan
+
+    @functools.cached_property
+    def _call(self) -> Callable:
+        # the callback, wrapped if it takes a PipeInput or if values of converters that set `releases` have to be closed
+        invocation_plan = self._invocation_plan
+        callback = self.callback
+        pipe_parameter = self._pipe_parameter
+        releases = any(plan.releases for _, plan in invocation_plan)
+        if pipe_parameter is None and not releases:
+            return callback
+
+        if inspect.iscoroutinefunction(callback):
+            async def call(*args, **kwargs):
+                if pipe_parameter is not None:
+                    kwargs[pipe_parameter] = _pipe_input.get() or PipeStream(None)
+                if not releases:
+                    return await callback(*args, **kwargs)
 
-        self.parent: Command | None = parent
-        self.children: list[Command] = []
+                try:
+                    return await callback(*args, **kwargs)
+                finally:
+                    _release_arguments(invocation_plan, args, kwargs)
+        else:
+            def call(*args, **kwargs):
+                if pipe_parameter is not None:
+                    kwargs[pipe_parameter] = _pipe_input.get() or PipeStream(None)
+                if not releases:
+                    return callback(*args, **kwargs)
 
-        self.execute = self.async_execute if inspect.iscoroutinefunction(self.callback) else self.sync_execute
+                try:
+                    result = callback(*args, **kwargs)
+                except BaseException:
+                    _release_arguments(invocation_plan, args, kwargs)
+                    raise
 
-    def __repr__(self):
-        return f'<Command name="{self.names[0]}">'
+                # generators only read their arguments as they're iterated
+                if inspect.isgenerator(result):
+                    return _release_after(result, invocation_plan, args, kwargs)
+                elif inspect.isasyncgen(result):
+                    return _async_release_after(result, invocation_plan, args, kwargs)
+
+                _release_arguments(invocation_plan, args, kwargs)
+                return result
+
+        return functools.wraps(callback)(call)
+
+    @functools.cached_property
+    def _pipe_parameter(self) -> str | None:
+        return next((param.name for param in self.parameters if param.annotation is PipeInput), None)
+
+    def resolve(self) -> None:
+        """Inspects the signature and compiles the parameters now instead of on first use, errors surface here"""
+        self._invocation_plan
+
+    @property
+    def qualified_name(self) -> str:
+        if self.parent is None:
+            return self.names[0]
+        return f"{self.parent.qualified_name} {self.names[0]}"
+
+    @property
+    def children(self) -> list[Command]:
+        return self.child_index.commands
+
+    def profile(self, count: int = 1, **kwargs) -> ProfileRequest:
+        """Profiles the next `count` invocations of this command, see `ProfileRequest` for the options"""
+        self._profile_request = ProfileRequest(self, count, **kwargs)
+        return self._profile_request
 
     def command(self, *args, **kwargs):
         def decorator(func):
             command = Command(func, *args, parent=self, **kwargs)
-            self.children.append(command)
+            self.child_index.add(command)
             return command
 
         return decorator
 
     def sync_execute(self, view: StringView, *, context=None):
         if self.children and not view.eof:
-            name = view.get_next_word()
-            for child in self.children:
-                if name in child.names:
-                    child.sync_execute(view, context=context)  # if the parent is sync I'll safely assume the child is too
-                    return
+            child = self.child_index.get(view.get_next_word())
+            if child is not None:
+                return child.sync_execute(view, context=context)  # if the parent is sync I'll safely assume the child is too
             view.undo()
 
+        if self.limiter is not None:
+            return self.limiter.call(context, self._sync_run, view, context)
+        return self._sync_run(view, context)
+
+    def _sync_run(self, view: StringView, context):
+        if self._profile_request is not None and (profiler := self._profile_request.take()) is not None:
+            return profiler.run(self._sync_invoke, view, context)
+
+        return self._sync_invoke(view, context)
+
+    def _sync_invoke(self, view: StringView, context):
+        if instrumentation.enabled:
+            return self._sync_invoke_instrumented(view, context)
+
+        args, kwargs = self._parse_arguments(view, context, self._invocation_plan)
+        return self._call(*args, **kwargs)
+
+    async def async_execute(self, view: StringView, *, context=None):
+        if self.children and not view.eof:
+            child = self.child_index.get(view.get_next_word())
+            if child is not None:
+                return await child.async_execute(view, context=context)  # if the parent is async I'll safely assume the child is too
+            view.undo()
+
+        awaitable = self._async_invoke(view, context)
+        if self.limiter is not None:  # waiting for a slot counts towards the timeout
+            awaitable = self.limiter.run(awaitable, context)
+        if self._profile_request is not None and (profiler := self._profile_request.take()) is not None:
+            awaitable = profiler.run_async(awaitable)
+
+        return await supervise(self, awaitable, view.string, context)
+
+    async def _async_invoke(self, view: StringView, context):
+        if instrumentation.enabled:
+            return await self._async_invoke_instrumented(view, context)
+
+        if self.concurrent_conversion:
+            args, kwargs = await self._async_gather_arguments(view, context, self._invocation_plan)
+        else:
+            args, kwargs = await self._async_parse_arguments(view, context, self._invocation_plan)
+
+        return await maybe_await(self._call, *args, **kwargs)
+
+    async def offloaded_execute(self, view: StringView, *, context=None):
+        if self.children and not view.eof:
+            child = self.child_index.get(view.get_next_word())
+            if child is not None:
+                return await maybe_await(child.execute, view, context=context)
+            view.undo()
+
+        # a timeout stops waiting for the worker, it can't stop the callback running in it (which then no longer holds a slot either)
+        profiler = self._profile_request.take() if self._profile_request is not None else None
+        awaitable = self._offloaded_invoke(view, context, profiler)
+        if self.limiter is not None:
+            awaitable = self.limiter.run(awaitable, context)
+        if profiler is not None:
+            awaitable = profiler.run_async(awaitable)
+
+        return await supervise(self, awaitable, view.string, context)
+
+    async def _offloaded_invoke(self, view: StringView, context, profiler: _Capture | None = None):
+        # the profiler only sees the thread it's enabled in, so the worker side gets profiled in the worker
+        if self.offload_conversion:
+            invoke = self._sync_invoke if profiler is None else profiler.in_worker(self._sync_invoke)
+            return await run_in_executor(executor=self.executor or get_thread_pool())(invoke)(view, context)
+
+        if instrumentation.enabled:
+            return await self._offloaded_invoke_instrumented(view, context, profiler)
+
+        args, kwargs = self._parse_arguments(view, context, self._invocation_plan)
+        return await self._offload_callback(args, kwargs, context, profiler)
+
+    def _offload_callback(self, args: list, kwargs: dict, context, profiler: _Capture | None = None):
+        if self.run_in == "process":  # worker processes aren't profiled, only the parsing and pickling here
+            payload = pickle_arguments(args, kwargs, has_context=context is not None)
+            return run_in_executor(executor=self.executor or get_process_pool())(call_in_worker)(
+                self.callback.__module__, self.callback.__qualname__, payload
+            )
+
+        call = self._call if profiler is None else profiler.in_worker(self._call)
+        return run_in_executor(executor=self.executor or get_thread_pool())(call)(*args, **kwargs)
+
+    async def _offloaded_invoke_instrumented(self, view: StringView, context, profiler: _Capture | None = None):
+        stats = instrumentation.get(self)
+        spent = stats.start()
+        parsed = error = None
+        start = perf_counter()
+
+        try:
+            args, kwargs = self._parse_arguments(view, context, stats.plan)
+            parsed = perf_counter()
+            return await self._offload_callback(args, kwargs, context, profiler)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            stats.record(start, parsed, perf_counter(), spent, error)
+
+    def _sync_invoke_instrumented(self, view: StringView, context):
+        stats = instrumentation.get(self)
+        spent = stats.start()
+        parsed = error = None
+        start = perf_counter()
+
+        try:
+            args, kwargs = self._parse_arguments(view, context, stats.plan)
+            parsed = perf_counter()
+            return self._call(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            stats.record(start, parsed, perf_counter(), spent, error)
+
+    async def _async_invoke_instrumented(self, view: StringView, context):
+        stats = instrumentation.get(self)
+        spent = stats.start()
+        parsed = error = None
+        start = perf_counter()
+
+        try:
+            if self.concurrent_conversion:
+                args, kwargs = await self._async_gather_arguments(view, context, stats.plan)
+            else:
+                args, kwargs = await self._async_parse_arguments(view, context, stats.plan)
+
+            parsed = perf_counter()
+            return await maybe_await(self._call, *args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            stats.record(start, parsed, perf_counter(), spent, error)
+
+    def _parse_arguments(self, view: StringView, context, invocation_plan: list[tuple[Parameter, ConversionPlan]]) -> tuple[list, dict]:
         args = []
         kwargs = {}
 
         if context is not None:
             args.append(context)
 
-        for i, param in enumerate(self.parameters[bool(context is not None):]):
+        for param, plan in invocation_plan[bool(context is not None):]:
             if param.kind == Parameter.POSITIONAL_ONLY or param.kind == Parameter.POSITIONAL_OR_KEYWORD:
                 try:
                     arg = view.get_next_word()
-                    value = convert(arg, view, param.annotation, context=context)
+                    value = plan.convert(arg, view, context)
                 except IndexError:
                     if param.required:
                         raise MissingRequiredArgument(param)
@@ -93,9 +407,13 @@ class Command:
 
                 args.append(value)
             elif param.kind == Parameter.VAR_POSITIONAL:
+                if plan.bulk and (words := view.get_rest_words()) is not None:
+                    args.extend(plan.convert_many(words, view, context))  # e.g. `*values: int`, parsed in one pass
+                    continue
+
                 while not view.eof:
                     arg = view.get_next_word()
-                    value = convert(arg, view, param.annotation, context=context)
+                    value = plan.convert(arg, view, context)
                     args.append(value)
             elif param.kind == Parameter.KEYWORD_ONLY:
                 arg = view.get_rest()
@@ -105,31 +423,23 @@ class Command:
                     else:
                         kwargs[param.name] = param.default
                 else:
-                    value = convert(arg, view, param.annotation, context=context)
+                    value = plan.convert(arg, view, context)
                     kwargs[param.name] = value
 
-        self.callback(*args, **kwargs)
-
-    async def async_execute(self, view: StringView, *, context=None):
-        if self.children and not view.eof:
-            name = view.get_next_word()
-            for child in self.children:
-                if name in child.names:
-                    await child.async_execute(view, context=context)  # if the parent is async I'll safely assume the child is too
-                    return
-            view.undo()
+        return args, kwargs
 
+    async def _async_parse_arguments(self, view: StringView, context, invocation_plan: list[tuple[Parameter, ConversionPlan]]) -> tuple[list, dict]:
         args = []
         kwargs = {}
 
         if context is not None:
             args.append(context)
 
-        for i, param in enumerate(self.parameters[bool(context is not None):]):
+        for param, plan in invocation_plan[bool(context is not None):]:
             if param.kind == Parameter.POSITIONAL_ONLY or param.kind == Parameter.POSITIONAL_OR_KEYWORD:
                 try:
                     arg = view.get_next_word()
-                    value = await async_convert(arg, view, param.annotation, context=context)
+                    value = await plan.async_convert(arg, view, context)
                 except IndexError:
                     if param.required:
                         raise MissingRequiredArgument(param)
@@ -138,9 +448,13 @@ class Command:
 
                 args.append(value)
             elif param.kind == Parameter.VAR_POSITIONAL:
+                if plan.bulk and (words := view.get_rest_words()) is not None:
+                    args.extend(plan.convert_many(words, view, context))  # e.g. `*values: int`, parsed in one pass
+                    continue
+
                 while not view.eof:
                     arg = view.get_next_word()
-                    value = await async_convert(arg, view, param.annotation, context=context)
+                    value = await plan.async_convert(arg, view, context)
                     args.append(value)
             elif param.kind == Parameter.KEYWORD_ONLY:
                 arg = view.get_rest()
@@ -150,13 +464,76 @@ class Command:
                     else:
                         kwargs[param.name] = param.default
                 else:
-                    value = await async_convert(arg, view, param.annotation, context=context)
+                    value = await plan.async_convert(arg, view, context)
                     kwargs[param.name] = value
 
-        await maybe_await(self.callback, *args, **kwargs)
+        return args, kwargs
 
+    async def _async_gather_arguments(self, view: StringView, context, invocation_plan: list[tuple[Parameter, ConversionPlan]]) -> tuple[list, dict]:
+        # Tokenizes everything first, converters that don't touch the view are then awaited together.
+        # Converters that do consume the view still run in order, as they're reached.
+        args = []
+        kwargs = {}
+        deferred: list[tuple[list | dict, int | str, ConversionPlan, str]] = []
 
-_command_list: list[Command] = []
+        if context is not None:
+            args.append(context)
+
+        for param, plan in invocation_plan[bool(context is not None):]:
+            if param.kind == Parameter.POSITIONAL_ONLY or param.kind == Parameter.POSITIONAL_OR_KEYWORD:
+                try:
+                    arg = view.get_next_word()
+                except IndexError:
+                    if param.required:
+                        raise MissingRequiredArgument(param)
+                    args.append(param.default)
+                    continue
+
+                if plan.consumes_view:
+                    args.append(await plan.async_convert(arg, view, context))
+                else:
+                    deferred.append((args, len(args), plan, arg))
+                    args.append(None)
+            elif param.kind == Parameter.VAR_POSITIONAL:
+                if plan.bulk and (words := view.get_rest_words()) is not None:
+                    args.extend(plan.convert_many(words, view, context))  # e.g. `*values: int`, parsed in one pass
+                    continue
+
+                while not view.eof:
+                    arg = view.get_next_word()
+                    if plan.consumes_view:
+                        args.append(await plan.async_convert(arg, view, context))
+                    else:
+                        deferred.append((args, len(args), plan, arg))
+                        args.append(None)
+            elif param.kind == Parameter.KEYWORD_ONLY:
+                arg = view.get_rest()
+                if not arg:
+                    if param.required:
+                        raise MissingRequiredArgument(param)
+                    kwargs[param.name] = param.default
+                elif plan.consumes_view:
+                    kwargs[param.name] = await plan.async_convert(arg, view, context)
+                else:
+                    deferred.append((kwargs, param.name, plan, arg))
+
+        if deferred:
+            results = await asyncio.gather(
+                *(plan.async_convert(arg, view, context) for _, _, plan, arg in deferred),
+                return_exceptions=True
+            )
+
+            # every converter has finished by now, the first failure in parameter order is the one raised
+            for (target, key, _, _), result in zip(deferred, results):
+                if isinstance(result, BaseException):
+                    raise result
+                target[key] = result  # type: ignore
+
+        return args, kwargs
+
+
+_command_index: CommandIndex = CommandIndex()
+_command_list: list[Command] = _command_index.commands
 
 
 def get_command_list() -> list[Command]:
@@ -164,19 +541,25 @@ def get_command_list() -> list[Command]:
     return _command_list
 
 
+def get_command_index() -> CommandIndex:
+    return _command_index
+
+
+def get_command(name: str) -> Command | None:
+    return _command_index.get(name)
+
+
 def add_command(command: Command) -> Command:
-    _command_list.append(command)
-    return command
+    return _command_index.add(command)
 
 
 def remove_command(command: Command | str) -> Command:
     if isinstance(command, Command):
-        _command_list.remove(command)
+        _command_index.remove(command)
     else:
-        for cmd in _command_list[::-1]:
-            if command in cmd.names:
-                _command_list.remove(cmd)
-                command = cmd
+        while (cmd := _command_index.get(command)) is not None:
+            _command_index.remove(cmd)
+            command = cmd
 
     return command  # type: ignore
 
@@ -194,13 +577,75 @@ def process_commands(string: str, *, context=None):
     view = StringView(string)
     name = view.get_next_word()
 
-    command = None
-    for cmd in _command_list:
-        if name in cmd.names:
-            command = cmd
-            break
-
+    command = _command_index.get(name)
     if command is None:
         raise CommandNotFound(name)
 
     return command.execute(view, context=context)  # type: ignore
+
+
+def process_pipeline(string: str, *, context=None):
+    """Runs `a | b | c`, the PipeInput parameter of each command gets a PipeStream over the output of the one before
+
+    Returns the output of the last command, iterate it through `PipeStream`. Generator and async generator commands
+    only run as far as their output is consumed. Without a standalone `|` it's the same as `process_commands`
+    """
+    stages = split_pipeline(string)
+    if len(stages) == 1:
+        return process_commands(string, context=context)
+
+    output = None
+    for index, stage in enumerate(stages):
+        if not stage:
+            raise ValueError(f"stage {index} of the pipeline is empty")
+
+        stream = PipeStream(output)
+        token = _pipe_input.set(stream)
+        try:
+            output = process_commands(stage, context=context)
+        finally:
+            _pipe_input.reset(token)
+
+        if isawaitable(output):
+            output = with_pipe_input(output, stream)
+
+    return output
+
+
+async def process_commands_batch(
+        lines: Iterable[str],
+        *,
+        context_factory: Callable[[str], Any] | None = None,
+        concurrency: int = 10
+) -> list[Any]:
+    """Runs every line through `process_commands`, returns the results (or raised exceptions) in input order
+
+    Sync commands run in order as their line is reached, async commands are scheduled with at most
+    `concurrency` of them running at the same time
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results: list[Any] = []
+    pending: list[tuple[int, asyncio.Future]] = []
+
+    for line in lines:
+        try:
+            out = process_commands(line, context=context_factory(line) if context_factory else None)
+        except Exception as e:
+            results.append(e)
+            continue
+
+        if isawaitable(out):
+            await semaphore.acquire()
+            future = asyncio.ensure_future(out)
+            future.add_done_callback(lambda _: semaphore.release())
+            pending.append((len(results), future))
+            out = None
+
+        results.append(out)
+
+    if pending:
+        outs = await asyncio.gather(*(future for _, future in pending), return_exceptions=True)
+        for (index, _), out in zip(pending, outs):
+            results[index] = out
+
+    return results
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from collections import deque
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Callable, Coroutine, Hashable
+
+from utilities.commands.errors import CommandBusy
+from utilities.commands.stats import Histogram
+
+if TYPE_CHECKING:
+    from utilities.commands import Command
+
+
+class _Waiter:
+    __slots__ = ("enqueued", "granted", "lock", "loop", "future")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop | None):
+        self.enqueued: float = perf_counter()
+        self.granted: bool = False
+        self.loop = loop
+        if loop is None:  # a sync caller blocks on the lock until it's handed a slot
+            self.lock: threading.Lock | None = threading.Lock()
+            self.lock.acquire()
+            self.future: asyncio.Future | None = None
+        else:
+            self.lock = None
+            self.future = loop.create_future()
+
+
+class _Bucket:
+    __slots__ = ("active", "waiters")
+
+    def __init__(self):
+        self.active: int = 0
+        self.waiters: deque[_Waiter] = deque()
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class ConcurrencyLimiter:
+    """Caps how many invocations of a command run at the same time, `Command.limiter` when `max_concurrency` is set
+
+    Invocations are counted per bucket, `key(context)` picks it (e.g. a user or a channel) and everything without
+    a key or a context shares one. Past the limit invocations wait their turn in order, at most `max_queue` of them
+    per bucket (unbounded if None), and the ones after that raise CommandBusy right away.
+    Sync commands block their thread while they wait, async ones are suspended
+    """
+
+    def __init__(
+            self,
+            command: Command,
+            max_concurrency: int,
+            *,
+            key: Callable[[Any], Hashable] | None = None,
+            max_queue: int | None = None
+    ):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if max_queue is not None and max_queue < 0:
+            raise ValueError("max_queue can't be negative")
+
+        self.command = command
+        self.max_concurrency = max_concurrency
+        self.key = key
+        self.max_queue = max_queue
+
+        self.wait_time = Histogram()  # how long admitted invocations waited, 0 for the ones that got a slot straight away
+        self.rejected: int = 0
+        self._buckets: dict[Hashable, _Bucket] = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<ConcurrencyLimiter command={self.command.qualified_name!r} active={self.active} waiting={self.waiting}>"
+
+    def bucket_for(self, context: Any) -> Hashable:
+        if self.key is None or context is None:
+            return None
+        return self.key(context)
+
+    @property
+    def active(self) -> int:
+        return sum(bucket.active for bucket in list(self._buckets.values()))
+
+    @property
+    def waiting(self) -> int:
+        """The queue depth, summed over every bucket"""
+        return sum(len(bucket.waiters) for bucket in list(self._buckets.values()))
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            buckets = {key: {"active": bucket.active, "waiting": len(bucket.waiters)} for key, bucket in self._buckets.items()}
+            return {
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "active": sum(bucket["active"] for bucket in buckets.values()),
+                "waiting": sum(bucket["waiting"] for bucket in buckets.values()),
+                "rejected": self.rejected,
+                "wait_time": self.wait_time.snapshot(),
+                "buckets": buckets,
+            }
+
+    def _enter(self, key: Hashable, loop: asyncio.AbstractEventLoop | None) -> _Waiter | None:
+        # called with the lock held, returns None if there was a free slot
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket()
+
+        if bucket.active < self.max_concurrency:  # there are only waiters while every slot is taken
+            bucket.active += 1
+            self.wait_time.record(0.0)
+            return None
+
+        if self.max_queue is not None and len(bucket.waiters) >= self.max_queue:
+            self.rejected += 1
+            raise CommandBusy(self.command, key, len(bucket.waiters))
+
+        waiter = _Waiter(loop)
+        bucket.waiters.append(waiter)
+        return waiter
+
+    def acquire(self, context: Any = None) -> Hashable:
+        """Takes a slot in the context's bucket, blocking until there's one. Returns the bucket to `release`"""
+        key = self.bucket_for(context)
+        with self._lock:
+            waiter = self._enter(key, None)
+
+        if waiter is not None:
+            waiter.lock.acquire()  # type: ignore
+        return key
+
+    async def async_acquire(self, context: Any = None) -> Hashable:
+        key = self.bucket_for(context)
+        with self._lock:
+            waiter = self._enter(key, asyncio.get_running_loop())
+
+        if waiter is not None:
+            try:
+                await waiter.future  # type: ignore
+            except BaseException:  # cancelled (or timed out) while waiting
+                with self._lock:
+                    granted = waiter.granted
+                    if not granted:
+                        self._buckets[key].waiters.remove(waiter)
+
+                if granted:  # the slot was already handed over, pass it on
+                    self.release(key)
+                raise
+
+        return key
+
+    def release(self, key: Hashable) -> None:
+        # a freed slot goes straight to the oldest waiter, so it can't be taken by an invocation that just arrived
+        with self._lock:
+            bucket = self._buckets[key]
+            while bucket.waiters:
+                waiter = bucket.waiters.popleft()
+                if waiter.lock is not None:
+                    waiter.lock.release()
+                else:
+                    try:
+                        waiter.loop.call_soon_threadsafe(_wake, waiter.future)  # type: ignore
+                    except RuntimeError:  # its loop is closed, nobody is waiting anymore
+                        continue
+
+                waiter.granted = True
+                self.wait_time.record(perf_counter() - waiter.enqueued)
+                return
+
+            bucket.active -= 1
+            if not bucket.active:
+                del self._buckets[key]
+
+    def call(self, context: Any, func: Callable, *args) -> Any:
+        key = self.acquire(context)
+        try:
+            return func(*args)
+        finally:
+            self.release(key)
+
+    async def run(self, awaitable: Coroutine, context: Any) -> Any:
+        try:
+            key = await self.async_acquire(context)
+        except BaseException:
+            awaitable.close()
+            raise
+
+        try:
+            return await awaitable
+        finally:
+            self.release(key)
@@ -1,34 +1,123 @@
+import array
 import inspect
+import mmap
+import os
 import re
+import time
+from collections import OrderedDict
 from types import UnionType
-from typing import Annotated, Any, Literal, Union, Callable
+from typing import Annotated, Any, Literal, Union, Callable, Hashable, Iterable, Iterator
 
-from utilities.commands.errors import ConversionError
-from utilities.commands.view import StringView
+from utilities.commands.errors import BulkConversionError, ConversionError
+from utilities.commands.index import PrefixIndex
+from utilities.commands.view import StringView, _quotes, _word_separator
 from utilities.color_utilities import Color
 from utilities.misc import maybe_await
 
 
+class ConverterCache:
+    """A bounded LRU cache for converter results, entries expire after `ttl` seconds if it's set
+
+    Enable it by setting `cache = ConverterCache(...)` on a Converter subclass or by adding it to
+    the metadata of an Annotated converter: `Annotated[Member, MemberConverter, ConverterCache()]`.
+    The converter has to set `consumes_view = False`, as a result that depends on the rest of the view
+    can't be reused. Caching a converter that doesn't, or one that sets `releases`, raises TypeError
+    """
+
+    def __init__(self, maxsize: int = 128, *, ttl: float | None = None, key: Callable[[Any], Hashable] | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key = key  # derives the context part of the key, e.g. `lambda ctx: ctx.guild.id`
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f"<ConverterCache size={len(self)}/{self.maxsize} hits={self.hits} misses={self.misses}>"
+
+    def make_key(self, plan: Any, argument: str, context: Any) -> Hashable:
+        return plan, argument, self.key(context) if self.key is not None else None
+
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        try:
+            value, expires = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+
+        if self.ttl is not None and expires < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return False, None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl is not None else 0.0
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
 class Converter:
-    get_completions = NotImplemented
+    __slots__ = ()
+
+    get_completions = NotImplemented  # may be a regular, async or async generator function
+    consumes_view: bool = True  # set this to False if `convert` only needs its argument, it can then run concurrently and be cached
+    releases: bool = False  # set this to True if the MappedFiles `convert` gives should be closed once the command returns
+    cache: ConverterCache | None = None
+    pattern: re.Pattern | None = None  # if set, `convert` is never tried on arguments it doesn't fully match
+
+    def can_convert(self, argument: str) -> bool | None:
+        """A cheap check Unions use to skip converters without raising, False means `convert` would certainly fail
+
+        None means it can't tell without trying, True still lets `convert` fail. Override it or set `pattern`
+        """
+        if self.pattern is None:
+            return None
+        return self.pattern.fullmatch(argument) is not None
 
     def convert(self, argument: str, view: StringView, context: Any):
         raise NotImplementedError
 
 
 class BoolConverter(Converter):
+    consumes_view = False
+    true_values = frozenset(["1", "yes", "y", "true"])
+    false_values = frozenset(["0", "no", "n", "false"])
+
+    def can_convert(self, argument: str) -> bool:
+        argument = argument.lower()
+        return argument in self.true_values or argument in self.false_values
+
     def convert(self, argument: str, _: StringView, __):
         argument = argument.lower()
 
-        if argument in ["1", "yes", "y", "true"]:
+        if argument in self.true_values:
             return True
-        elif argument in ["0", "no", "n", "false"]:
+        elif argument in self.false_values:
             return False
         else:
             raise ConversionError(f"{argument} could not be converted into a bool")
 
 
 class _ColorConverter(Converter):
+    # loose on purpose, anything Color.from_str could parse matches: hex digits (with # or 0x) or an rgb(...) tuple
+    consumes_view = False
+    pattern = re.compile(r"[\s\da-fA-FxX#_+-]+|(?:rgb)?\(.*", re.DOTALL)
+
     def convert(self, argument: str, _: StringView, __: Any):
         try:
             color = Color.from_str(argument)
@@ -39,6 +128,260 @@ class _ColorConverter(Converter):
 ColorConverter = Annotated[Color, _ColorConverter]
 
 
+def convert_numbers(arguments: list[str], type_: type[int] | type[float]) -> list:
+    """Converts every argument with `type_` in one pass, a bad one raises `BulkConversionError` with its index"""
+    try:
+        return list(map(type_, arguments))
+    except ValueError:
+        pass
+
+    for index, argument in enumerate(arguments):
+        try:
+            type_(argument)
+        except ValueError as e:
+            raise BulkConversionError(index, argument, e) from e
+
+    raise ConversionError(f"{arguments} could not be converted")  # unreachable, map failed on something
+
+
+_numpy: Any = None
+
+
+def _import_numpy() -> Any:
+    # numpy is optional and slow to import, so it's only imported by the first NumericArray that wants it
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy  # type: ignore
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy
+
+
+class NumericArray(Converter):
+    """Reads the argument and every one after it as numbers, into an `array.array` or a numpy array when available
+
+    `NumericArray` alone gives floats, `NumericArray(int)` integers. `numpy=False` always gives an `array.array`,
+    `numpy=True` requires numpy
+    """
+    __slots__ = ("type", "typecode", "numpy")
+    consumes_view = True
+
+    def __init__(self, type_: type[int] | type[float] = float, *, numpy: bool | None = None):
+        if type_ not in (int, float):
+            raise TypeError(f"NumericArray only supports int and float, not {type_!r}")
+
+        self.type = type_
+        self.typecode = "q" if type_ is int else "d"
+        self.numpy = numpy
+
+    def __repr__(self):
+        return f"<NumericArray type={self.type.__name__}>"
+
+    def convert(self, argument: str, view: StringView, context: Any):
+        arguments = argument.split()
+        rest = view.get_rest_words()
+        if rest is None:
+            while not view.eof:
+                arguments.append(view.get_next_word())
+        else:
+            arguments.extend(rest)
+
+        values = convert_numbers(arguments, self.type)
+
+        numpy = _import_numpy() if self.numpy is not False else None
+        if numpy:
+            return numpy.array(values, dtype=numpy.int64 if self.type is int else numpy.float64)
+        elif self.numpy:
+            raise ConversionError("NumericArray(numpy=True) requires numpy to be installed")
+
+        try:
+            return array.array(self.typecode, values)
+        except OverflowError:
+            pass
+
+        checked = array.array(self.typecode)
+        for index, value in enumerate(values):
+            try:
+                checked.append(value)
+            except OverflowError as e:
+                raise BulkConversionError(index, arguments[index], e) from e
+        return checked
+
+
+class MappedFile:
+    """A read only memory map of a file, slices of `data`, `lines()` and `chunks()` are views into it and don't copy
+
+    Commands get it from FileConverter, it's closed once the command returns. Views that are still alive by then
+    keep the mapping open until they're garbage collected, copy them with `bytes()` to keep the data around
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            # a zero length file can't be mapped
+            self._mmap: mmap.mmap | None = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(self._file.fileno()).st_size else None
+        except BaseException:
+            self._file.close()
+            raise
+
+        self.data: memoryview = memoryview(self._mmap if self._mmap is not None else b"")
+
+    def __repr__(self):
+        return f"<MappedFile path={self.path!r} size={len(self)} closed={self.closed}>"
+
+    def __len__(self):
+        return self.data.nbytes if not self.closed else 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def lines(self, *, keepends: bool = False) -> Iterator[memoryview]:
+        # newlines are found by the mmap itself, so the file is never copied into a bytes object
+        find = self._mmap.find if self._mmap is not None else None
+        data = self.data
+        size = data.nbytes
+        start = 0
+
+        while start < size:
+            end = find(b"\n", start)  # type: ignore
+            if end == -1:
+                yield data[start:]
+                return
+
+            yield data[start:end + 1 if keepends else end]
+            start = end + 1
+
+    def chunks(self, size: int = 1 << 16) -> Iterator[memoryview]:
+        data = self.data
+        for start in range(0, data.nbytes, size):
+            yield data[start:start + size]
+
+    def close(self) -> None:
+        if self.closed:
+            return
+
+        self.data.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:  # the callback kept a view, it closes when the last one is collected
+                pass
+
+        self._file.close()
+
+
+class FileConverter(Converter):
+    """Converts a path into a MappedFile
+
+    `root` restricts paths to a directory (relative paths are taken from it), `extensions` to certain file types.
+    Paths complete from cached directory listings
+    """
+    consumes_view = False
+    releases = True
+    root: str | None = None
+    extensions: frozenset[str] | None = None
+
+    _listings: ConverterCache = ConverterCache(64)
+
+    def __init__(self, *, root: str | os.PathLike | None = None, extensions: Iterable[str] | None = None):
+        if root is not None:
+            self.root = os.path.realpath(root)
+        if extensions is not None:
+            self.extensions = frozenset(extension.lower() for extension in extensions)
+
+    def resolve(self, argument: str) -> str:
+        path = os.path.expanduser(argument)
+        if self.root is None:
+            return path
+
+        path = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ConversionError(f"{argument} is outside of {self.root}")
+        return path
+
+    def convert(self, argument: str, view: StringView, context: Any) -> MappedFile:
+        path = self.resolve(argument)
+        if not os.path.isfile(path):
+            raise ConversionError(f"{argument} is not a file")
+        if self.extensions is not None and os.path.splitext(path)[1].lower() not in self.extensions:
+            raise ConversionError(f"{argument} is not one of {', '.join(sorted(self.extensions))}")
+
+        try:
+            return MappedFile(path)
+        except OSError as e:
+            raise ConversionError(f"{argument} could not be opened: {e}")
+
+    @classmethod
+    def list_directory(cls, directory: str) -> list[tuple[str, bool]]:
+        """(name, is_dir) of everything in `directory`, cached until its mtime changes"""
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return []
+
+        found, cached = cls._listings.get(directory)
+        if found and cached[0] == mtime:
+            return cached[1]
+
+        try:
+            with os.scandir(directory) as entries:
+                listing = sorted((entry.name, entry.is_dir()) for entry in entries)
+        except OSError:
+            listing = []
+
+        cls._listings.set(directory, (mtime, listing))
+        return listing
+
+    def get_completions(self, value: str) -> list[str]:
+        head, _, prefix = value.rpartition("/")
+        directory = head or ("/" if value.startswith("/") else ".")
+        if self.root is not None and not os.path.isabs(directory):
+            directory = os.path.join(self.root, directory)
+
+        completions = []
+        for name, is_dir in self.list_directory(os.path.expanduser(directory)):
+            if not name.startswith(prefix) or (name.startswith(".") and not prefix.startswith(".")):
+                continue
+            if is_dir:
+                completions.append(f"{head}/{name}/" if head or value.startswith("/") else f"{name}/")
+            elif self.extensions is None or os.path.splitext(name)[1].lower() in self.extensions:
+                completions.append(f"{head}/{name}" if head or value.startswith("/") else name)
+
+        return completions
+
+
+def _compile_flag_constructor(result: type, names: list[str]) -> staticmethod:
+    # builds `def _construct(a, b): self = new(result); self.a = a; self.b = b; return self`
+    lines = [f"def _construct({', '.join(names)}):", "    __self = __new(__result)"]
+    lines.extend(f"    __self.{name} = {name}" for name in names)
+    lines.append("    return __self")
+
+    namespace: dict[str, Any] = {"__new": object.__new__, "__result": result}
+    exec("\n".join(lines), namespace)
+    return staticmethod(namespace["_construct"])
+
+
+def _setting(converter: Any, name: str) -> Any:
+    # a FlagConverter flag can share its name with a Converter setting, its default isn't a setting though
+    if name not in getattr(converter, "_flag_parameters", ()):
+        return getattr(converter, name)
+
+    for klass in (converter if inspect.isclass(converter) else type(converter)).__mro__:
+        if name in vars(klass) and name not in vars(klass).get("_flag_parameters", ()):
+            return vars(klass)[name]
+    return getattr(Converter, name)
+
+
 class FlagConverterMetaClass(type):
     def __new__(cls, name, bases, attrs, *, prefix="--", delimiter=" "):
         attrs['_prefix'] = prefix
@@ -60,168 +403,388 @@ class FlagConverterMetaClass(type):
             parameters[flag_name] = inspect.Parameter(flag_name, kind, **kwargs)
 
         attrs['_flag_names'] = names
-        attrs['_regex_pattern'] = re.compile(f"(({re.escape(prefix)})(?P<flag>{'|'.join(names)}){re.escape(delimiter)})")
+        attrs['_flag_index'] = PrefixIndex(names)
+        # flag names are identifiers, so one pattern that doesn't depend on the names can find every candidate
+        boundary = "" if prefix else r"(?<![^ \n])"
+        attrs['_flag_pattern'] = re.compile(rf"{boundary}{re.escape(prefix)}([A-Za-z_]\w*){re.escape(delimiter)}")
         attrs['_flag_parameters'] = parameters
 
-        return type.__new__(cls, name, bases, attrs)
+        attrs['_flag_defaults'] = {
+            flag_name: parameter.default for flag_name, parameter in parameters.items() if parameter.default is not inspect.Parameter.empty
+        }
+        attrs['_required_flags'] = [flag_name for flag_name in names if flag_name not in attrs['_flag_defaults']]
+        attrs['_flag_plans'] = None  # {flag name: (origin, plan)} with origin list, tuple or None, compiled by the first convert
+
+        klass = type.__new__(cls, name, bases, attrs)
+
+        # results only ever hold their flag values, so convert builds them as a slotted subclass. The flags
+        # stay off the converter itself, where slots would hide its defaults and settings
+        klass._flag_result = type.__new__(cls, name, (klass,), {
+            '__slots__': tuple(names), '__module__': klass.__module__, '__qualname__': f"{klass.__qualname__}._flag_result"
+        })
+        klass._construct = _compile_flag_constructor(klass._flag_result, names)
+        return klass
 
 
 class FlagConverter(Converter, metaclass=FlagConverterMetaClass):  # TODO: reconvert annotations from str when using __future__
+    consumes_view = False  # flag values come from the argument alone
+
     def __init__(self, **kwargs):
-        for key, value in kwargs.items():
+        for key, value in {**self._flag_defaults, **kwargs}.items():  # type: ignore
             setattr(self, key, value)
 
+    def can_convert(self, argument: str) -> bool | None:
+        pattern = _setting(self, "pattern")
+        if pattern is None:
+            return None
+        return pattern.fullmatch(argument) is not None
+
     def __repr__(self):
-        return f"<{self.__class__.__name__} {' '.join(k+'='+str(v) for k, v in self.__dict__.items())}>"
+        return f"<{self.__class__.__name__} {' '.join(k+'='+str(getattr(self, k)) for k in self._flag_names if hasattr(self, k))}>"  # type: ignore
+
+    @classmethod
+    def scan_flags(cls, argument: str) -> list[tuple[str, int, int]]:
+        """Finds every flag in `argument` in a single pass, returns (flag name, value start, value end) spans"""
+        parameters: dict = cls._flag_parameters  # type: ignore
+
+        found: list[tuple[str, int, int]] = []  # (flag name, flag start, value start)
+        for match in cls._flag_pattern.finditer(argument):  # type: ignore
+            if (flag_name := match.group(1)) in parameters:  # anything else is part of the previous flag's value
+                found.append((flag_name, match.start(), match.end()))
+
+        spans: list[tuple[str, int, int]] = []
+        for num, (flag_name, _, value_start) in enumerate(found, start=1):
+            value_end = found[num][1] if num < len(found) else len(argument)
+            if num < len(found):
+                while value_end > value_start and argument[value_end - 1] in " \n":
+                    value_end -= 1
+
+            spans.append((flag_name, value_start, value_end))
+
+        return spans
+
+    @classmethod
+    def _compile_flags(cls) -> dict[str, tuple[Any, "ConversionPlan"]]:
+        # compiled on first use rather than with the class, like command parameters
+        plans = {}
+        for flag_name, parameter in cls._flag_parameters.items():  # type: ignore
+            origin = getattr(parameter.annotation, "__origin__", None)
+            if origin in (list, tuple):
+                plans[flag_name] = (origin, compile_annotation(parameter.annotation.__args__[0]))
+            else:
+                plans[flag_name] = (None, compile_annotation(parameter.annotation))
+
+        cls._flag_plans = plans
+        return plans
 
     def convert(self, argument: str, view: StringView, ctx: Any):
+        # values are converted straight from their spans, only converters that read further need a view of their own
         arguments = {}
+        plans = self._flag_plans if self._flag_plans is not None else self._compile_flags()  # type: ignore
 
-        matches = list(self._regex_pattern.finditer(argument))  # type: ignore
-        for num, i in enumerate(matches, start=1):
-            flag_name = i.group('flag')
-            argument_start = i.span()[1]
+        for flag_name, start, end in self.scan_flags(argument):
+            string = argument[start:end]
+            origin, plan = plans[flag_name]
 
-            if num == len(matches):
-                string = argument[argument_start:]
-            else:
-                next_match = matches[num]
-                argument_end = next_match.span()[0]
-                string = argument[argument_start:argument_end - 1]
-
-            parameter = self._flag_parameters[flag_name]  # type: ignore
-            v = StringView(string)
+            if origin is not list and flag_name in arguments:
+                raise ConversionError(f'flag "{flag_name}" was passed more than once')
 
-            origin = getattr(parameter.annotation, "__origin__", None)
-            if origin in (list, tuple):
-                annotation = parameter.annotation.__args__[0]
-                if origin == list:
-                    converted = convert(string, v, annotation, ctx)
-                    arguments.setdefault(flag_name, []).append(converted)
-                elif origin == tuple:
+            if origin is tuple:
+                if plan.consumes_view or _quotes.search(string):
+                    v = StringView(string)
                     lst = []
                     while not v.eof:
                         word = v.get_next_word()
-                        converted = convert(word, v, annotation, ctx)
-                        lst.append(converted)
-                    arguments[flag_name] = lst
+                        lst.append(plan.convert(word, v, ctx))
+                else:
+                    words = string.strip(" \n")
+                    lst = plan.convert_many(_word_separator.split(words) if words else [], view, ctx)
+                arguments[flag_name] = lst
+                continue
+
+            converted = plan.convert(string, StringView(string) if plan.consumes_view else view, ctx)
+            if origin is list:
+                arguments.setdefault(flag_name, []).append(converted)
             else:
-                arguments[flag_name] = convert(string, v, parameter.annotation, ctx)
+                arguments[flag_name] = converted
 
-        for flag_name in self._flag_names:  # type: ignore
-            parameter = self._flag_parameters[flag_name]  # type: ignore
-            if flag_name not in arguments:
-                if parameter.default == inspect.Parameter.empty:
+        if len(arguments) != len(self._flag_names):  # type: ignore
+            for flag_name in self._required_flags:  # type: ignore
+                if flag_name not in arguments:
                     raise Exception(f'missing required flag "{flag_name}"')
-                else:
-                    arguments[flag_name] = parameter.default
 
-        return type(self)(**arguments)
+            arguments = {**self._flag_defaults, **arguments}  # type: ignore
+
+        return self._construct(*map(arguments.__getitem__, self._flag_names))  # type: ignore
+
+
+class ConversionPlan:
+    """A pre-resolved conversion for a single annotation, built once by `compile_annotation`"""
+    consumes_view: bool = False
+    releases: bool = False  # the values it gives have to be closed once the command returns
+    bulk: bool = False  # variadic parameters hand all their arguments to `convert_many` at once if set
+
+    def convert_many(self, arguments: list[str], view: StringView, context: Any) -> list:
+        return [self.convert(argument, view, context) for argument in arguments]
+
+    def can_convert(self, argument: str) -> bool | None:
+        # False if `convert` would certainly fail, None if that can't be known without trying
+        return None
 
+    def convert(self, argument: str, view: StringView, context: Any):
+        raise NotImplementedError
+
+    async def async_convert(self, argument: str, view: StringView, context: Any):
+        return self.convert(argument, view, context)
+
+
+class _NullPlan(ConversionPlan):
+    def can_convert(self, argument: str) -> bool:
+        return True
+
+    def convert(self, argument: str, view: StringView, context: Any):
+        return None
+
+
+# supersets of what int() and float() accept, they only need to be exact about what certainly fails
+_type_patterns: dict[Any, re.Pattern] = {
+    int: re.compile(r"\s*[+-]?\d[\d_]*\s*"),
+    float: re.compile(r"\s*[+-]?(?:[\d_]*\.?[\d_]*(?:e[+-]?[\d_]+)?|inf(?:inity)?|nan)\s*", re.IGNORECASE),
+}
+
+
+class _TypePlan(ConversionPlan):
+    def __init__(self, type_: Callable):
+        self.type = type_
+        self.pattern = _type_patterns.get(type_)
+        self.bulk = type_ in (int, float)
+
+    def can_convert(self, argument: str) -> bool | None:
+        if self.pattern is None:
+            return None
+        return self.pattern.fullmatch(argument) is not None
+
+    def convert(self, argument: str, view: StringView, context: Any):
+        try:
+            return self.type(argument)
+        except Exception as e:
+            raise ConversionError(e)
+
+    def convert_many(self, arguments: list[str], view: StringView, context: Any) -> list:
+        if self.bulk:
+            return convert_numbers(arguments, self.type)  # type: ignore
+        return super().convert_many(arguments, view, context)
+
+
+class _ConverterPlan(ConversionPlan):
+    def __init__(self, converter: Converter):
+        self.converter = converter
+        self.consumes_view = _setting(converter, "consumes_view")
+        self.releases = _setting(converter, "releases")
+        self.can_convert = converter.can_convert  # type: ignore
+
+    def convert(self, argument: str, view: StringView, context: Any):
+        try:
+            return self.converter.convert(argument, view, context)
+        except ConversionError:
+            raise
+        except Exception as e:
+            raise ConversionError(e)
+
+    async def async_convert(self, argument: str, view: StringView, context: Any):
+        try:
+            return await maybe_await(self.converter.convert, argument, view, context)
+        except ConversionError:
+            raise
+        except Exception as e:
+            raise ConversionError(e)
 
-def handle_origin(argument: str, view: StringView, annotation: Any, origin: Any, context):
-    if isinstance(origin, UnionType) or origin is Union:
-        for converter in annotation.__args__:
-            if converter is type(None):
+
+class _FunctionPlan(ConversionPlan):
+    consumes_view = True  # there's no telling what a plain function does with the view
+
+    def __init__(self, func: Callable):
+        self.func = func
+
+    def convert(self, argument: str, view: StringView, context: Any):
+        try:
+            return self.func(argument, view, context)
+        except Exception as e:
+            raise ConversionError(e)
+
+    async def async_convert(self, argument: str, view: StringView, context: Any):
+        try:
+            return await maybe_await(self.func, argument, view, context)
+        except Exception as e:
+            raise ConversionError(e)
+
+
+class _LiteralPlan(ConversionPlan):
+    def __init__(self, values: tuple):
+        self.values = frozenset(values)
+
+    def can_convert(self, argument: str) -> bool:
+        return argument in self.values
+
+    def convert(self, argument: str, view: StringView, context: Any):
+        if argument in self.values:
+            return argument
+        raise ConversionError(f"{argument} could not be converted into any literal.")
+
+
+class _UnionPlan(ConversionPlan):
+    def __init__(self, members: list[ConversionPlan | None]):
+        # `None` stands in for NoneType, it stops the chain and gives the argument back to the view
+        self.members = members
+        self.consumes_view = any(member is None or member.consumes_view for member in members)
+        self.releases = any(member is not None and member.releases for member in members)
+
+    def can_convert(self, argument: str) -> bool | None:
+        result: bool | None = False
+        for member in self.members:
+            can_convert = True if member is None else member.can_convert(argument)
+            if can_convert:
+                return True
+            elif can_convert is None:
+                result = None
+
+        return result
+
+    def convert(self, argument: str, view: StringView, context: Any):
+        # members that can tell they won't match are skipped, only the rest are tried and may raise
+        for member in self.members:
+            if member is None:
                 view.undo()
                 return None
 
+            if member.can_convert(argument) is False:
+                continue
+
             try:
-                return convert(argument, view, converter, context)
-            except:
+                return member.convert(argument, view, context)
+            except Exception:
                 pass
 
         raise ConversionError(f"{argument} could not be converted")
-    elif origin is Annotated:
-        annotated_args = annotation.__args__
 
-        if origin := getattr(annotated_args[1], "__origin__", None):
-            return handle_origin(argument, view, annotated_args[1], origin, context)
-        else:
-            return convert(argument, view, annotated_args[1], context)
-    elif origin is Literal:
-        args = annotation.__args__
-        if argument in args:
-            return argument
-        else:
-            raise ConversionError(f"{argument} could not be converted into any literal.")
-
-
-async def async_handle_origin(argument: str, view: StringView, annotation: Any, origin: Any, context):
-    if isinstance(origin, UnionType) or origin is Union:
-        for converter in annotation.__args__:
-            if converter is type(None):
+    async def async_convert(self, argument: str, view: StringView, context: Any):
+        for member in self.members:
+            if member is None:
                 view.undo()
                 return None
 
+            if member.can_convert(argument) is False:
+                continue
+
             try:
-                return await async_convert(argument, view, converter, context)
-            except:
+                return await member.async_convert(argument, view, context)
+            except Exception:
                 pass
 
         raise ConversionError(f"{argument} could not be converted")
-    elif origin is Annotated:
-        annotated_args = annotation.__args__
 
-        if origin := getattr(annotated_args[1], "__origin__", None):
-            return await async_handle_origin(argument, view, annotated_args[1], origin, context)
-        else:
-            return await async_convert(argument, view, annotated_args[1], context)
-    elif origin is Literal:
-        args = annotation.__args__
-        if argument in args:
-            return argument
+
+class _CachedPlan(ConversionPlan):
+    def __init__(self, plan: ConversionPlan, cache: ConverterCache):
+        self.plan = plan
+        self.cache = cache
+        self.can_convert = plan.can_convert  # type: ignore
+
+    def convert(self, argument: str, view: StringView, context: Any):
+        key = self.cache.make_key(self.plan, argument, context)
+        found, value = self.cache.get(key)
+        if found:
+            return value
+
+        value = self.plan.convert(argument, view, context)
+        self.cache.set(key, value)
+        return value
+
+    async def async_convert(self, argument: str, view: StringView, context: Any):
+        key = self.cache.make_key(self.plan, argument, context)
+        found, value = self.cache.get(key)
+        if found:
+            return value
+
+        value = await self.plan.async_convert(argument, view, context)
+        self.cache.set(key, value)
+        return value
+
+
+def _maybe_cached(plan: ConversionPlan, cache: ConverterCache | None, converter: Any) -> ConversionPlan:
+    # the result of a converter that reads more of the view depends on more than its argument,
+    # and values that are closed after every command can't be handed out again
+    if cache is None:
+        return plan
+    if plan.consumes_view:
+        raise TypeError(f"{converter!r} can't be cached, it has to set consumes_view = False")
+    if plan.releases:
+        raise TypeError(f"{converter!r} can't be cached, the values it gives are closed after every command")
+    return _CachedPlan(plan, cache)
+
+
+def _compile_union(args: tuple) -> _UnionPlan:
+    members: list[ConversionPlan | None] = []
+    for arg in args:
+        if arg is type(None):
+            members.append(None)
+            continue
+
+        plan = compile_annotation(arg)
+        if isinstance(plan, _UnionPlan):
+            members.extend(plan.members)
         else:
-            raise ConversionError(f"{argument} could not be converted into any literal.")
+            members.append(plan)
+
+    return _UnionPlan(members)
 
 
-def convert(argument: str, view: StringView, annotation: Any, context=None):  # type: ignore
+def _compile(annotation: Any) -> ConversionPlan:
     if annotation is bool:
         annotation = BoolConverter
 
-    annotation: Converter | Callable
-
     if hasattr(annotation, "__metadata__"):
-        annotation = annotation.__metadata__[0]  # type: ignore
-    else:
-        origin = getattr(annotation, "__origin__", None) or (isinstance(annotation, UnionType) and annotation)
-        if origin:
-            return handle_origin(argument, view, annotation, origin, context)
+        plan = compile_annotation(annotation.__metadata__[0])
+        cache = next((item for item in annotation.__metadata__[1:] if isinstance(item, ConverterCache)), None)
+        return _maybe_cached(plan, cache, annotation.__metadata__[0])
 
-    try:
-        if annotation in [str, int, float]:
-            return annotation(argument)  # type: ignore
-        elif isinstance(annotation, Converter):
-            return annotation.convert(argument, view, context)
-        elif inspect.isclass(annotation) and issubclass(annotation, Converter):
-            return annotation().convert(argument, view, context)
-        elif inspect.isfunction(annotation):
-            return annotation(argument, view, context)
-    except Exception as e:
-        raise ConversionError(e)
-
-
-async def async_convert(argument: str, view: StringView, annotation: Any, context=None):  # type: ignore
-    if annotation is bool:
-        annotation = BoolConverter
+    origin = getattr(annotation, "__origin__", None) or (isinstance(annotation, UnionType) and annotation)
+    if origin:
+        if isinstance(origin, UnionType) or origin is Union:
+            return _compile_union(annotation.__args__)
+        elif origin is Literal:
+            return _LiteralPlan(annotation.__args__)
+        return _NullPlan()
 
-    annotation: Converter | Callable
+    if annotation in (str, int, float):
+        return _TypePlan(annotation)
+    elif isinstance(annotation, Converter):
+        return _maybe_cached(_ConverterPlan(annotation), _setting(annotation, "cache"), annotation)
+    elif inspect.isclass(annotation) and issubclass(annotation, Converter):
+        return _maybe_cached(_ConverterPlan(annotation()), _setting(annotation, "cache"), annotation)
+    elif inspect.isfunction(annotation):
+        return _FunctionPlan(annotation)
+
+    return _NullPlan()
+
+
+_plans: dict[Any, ConversionPlan] = {}
 
-    if hasattr(annotation, "__metadata__"):
-        annotation = annotation.__metadata__[0]  # type: ignore
-    else:
-        origin = getattr(annotation, "__origin__", None) or (isinstance(annotation, UnionType) and annotation)
-        if origin:
-            return await async_handle_origin(argument, view, annotation, origin, context)
 
+def compile_annotation(annotation: Any) -> ConversionPlan:
     try:
-        if annotation in [str, int, float]:
-            return annotation(argument)  # type: ignore
-        elif isinstance(annotation, Converter):
-            return await maybe_await(annotation.convert, argument, view, context)
-        elif inspect.isclass(annotation) and issubclass(annotation, Converter):
-            return await maybe_await(annotation().convert, argument, view, context)
-        elif inspect.isfunction(annotation):
-            return await maybe_await(annotation, argument, view, context)
-    except Exception as e:
-        raise ConversionError(e)
+        return _plans[annotation]
+    except KeyError:
+        plan = _plans[annotation] = _compile(annotation)
+    except TypeError:  # unhashable annotation
+        plan = _compile(annotation)
+
+    return plan
+
+
+def convert(argument: str, view: StringView, annotation: Any, context=None):
+    return compile_annotation(annotation).convert(argument, view, context)
+
+
+async def async_convert(argument: str, view: StringView, annotation: Any, context=None):
+    return await compile_annotation(annotation).async_convert(argument, view, context)
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import asyncio
+import importlib
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import threading
+import zlib
+from concurrent.futures import Future
+from inspect import isawaitable
+from typing import Any, Callable, Hashable, Iterable
+
+from utilities.commands.command import process_commands
+from utilities.commands.errors import UnpicklableArgument, WorkerDied
+
+
+def _worker_main(tasks, results, modules: tuple[str, ...]) -> None:
+    for module in modules:
+        importlib.import_module(module)  # registers the commands, needed with the "spawn" start method
+
+    loop = asyncio.new_event_loop()
+    while (task := tasks.get()) is not None:
+        task_id, line, context = task
+        try:
+            out = process_commands(line, context=context)
+            if isawaitable(out):
+                out = loop.run_until_complete(out)
+            result = (task_id, True, out)
+        except Exception as e:
+            result = (task_id, False, e)
+
+        try:
+            results.put(result)
+        except Exception as e:  # the result (or exception) couldn't be pickled
+            results.put((task_id, False, RuntimeError(f"the result of {line!r} couldn't be sent back: {e!r}")))
+
+    loop.close()
+
+
+class ShardedDispatcher:
+    """Runs `process_commands` in `workers` processes, each with its own copy of the command registry
+
+    Lines are routed by `key(context)` (or an explicit `key`) through a stable hash, so everything with the same key
+    goes to the same worker and runs in the order it was submitted. Lines without a key are spread round robin.
+    `modules` are imported by every worker, with the default "fork" start method the registry is inherited anyway.
+    Contexts, results and exceptions all cross process boundaries, so they have to be picklable.
+    If a worker dies, whatever was pending on it fails with WorkerDied and a new worker takes its shard over
+    """
+
+    def __init__(
+            self,
+            workers: int = 4,
+            *,
+            modules: Iterable[str] = (),
+            key: Callable[[Any], Hashable] | None = None,
+            mp_context: multiprocessing.context.BaseContext | None = None
+    ):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+
+        self._mp_context = mp_context or multiprocessing.get_context()
+        self._modules = tuple(modules)
+        self.key = key
+        self._futures: dict[int, tuple[tuple[int, int], Future]] = {}  # task id -> ((shard, serial) of its worker, future)
+        self._ids = itertools.count()
+        self._round_robin = itertools.count()
+        self._serials = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stopped: set[int] = set()  # shards whose worker exited while closing, they aren't replaced
+
+        # a queue per worker keeps each shard in order, results all come back through one
+        self._results = self._mp_context.SimpleQueue()
+        self._queues: list[Any] = [None] * workers
+        self._workers: list[Any] = [None] * workers
+        self._worker_ids: list[tuple[int, int]] = [(0, 0)] * workers
+        for shard in range(workers):
+            self._start_worker(shard)
+
+        self._result_thread = threading.Thread(target=self._read_results, name="dispatcher-results", daemon=True)
+        self._result_thread.start()
+        self._watch_thread = threading.Thread(target=self._watch_workers, name="dispatcher-workers", daemon=True)
+        self._watch_thread.start()
+
+    def __repr__(self):
+        return f"<ShardedDispatcher workers={len(self._workers)} pending={len(self._futures)}>"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _start_worker(self, shard: int):
+        # a killed worker can die holding its queue's lock, so a replacement never reuses the queue
+        queue = self._mp_context.SimpleQueue()
+        worker = self._mp_context.Process(target=_worker_main, args=(queue, self._results, self._modules), daemon=True)
+        worker.start()
+        self._queues[shard] = queue
+        self._workers[shard] = worker
+        self._worker_ids[shard] = (shard, next(self._serials))
+
+    def _watch_workers(self):
+        # a dead worker can't say so, its sentinel becomes ready instead. The exit is reported through the results,
+        # so the result thread still gets everything the worker sent before it died first
+        while True:
+            with self._lock:
+                sentinels = {worker.sentinel: shard for shard, worker in enumerate(self._workers) if shard not in self._stopped}
+            if not sentinels:
+                return
+
+            for sentinel in multiprocessing.connection.wait(list(sentinels)):
+                shard = sentinels[sentinel]
+                with self._lock:
+                    worker, worker_id = self._workers[shard], self._worker_ids[shard]
+                    if self._closed:
+                        self._stopped.add(shard)
+                    else:
+                        self._start_worker(shard)
+
+                worker.join()
+                self._results.put((None, worker_id, worker.exitcode))
+
+    def _read_results(self):
+        while (result := self._results.get()) is not None:
+            task_id, ok, value = result
+            if task_id is None:  # (None, worker id, exit code) from _watch_workers
+                self._worker_died(ok, value)
+                continue
+
+            with self._lock:
+                _, future = self._futures.pop(task_id, (None, None))
+
+            if future is None:
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _worker_died(self, worker_id: tuple[int, int], exitcode: int | None):
+        with self._lock:
+            failed = [task_id for task_id, (task_worker, _) in self._futures.items() if task_worker == worker_id]
+            futures = [self._futures.pop(task_id)[1] for task_id in failed]
+
+        for future in futures:
+            future.set_exception(WorkerDied(worker_id[0], exitcode))
+
+    def shard_for(self, key: Hashable | None) -> int:
+        if key is None:
+            return next(self._round_robin) % len(self._queues)
+        return zlib.crc32(str(key).encode()) % len(self._queues)  # `hash` of a str differs between processes
+
+    def submit(self, line: str, *, context: Any = None, key: Hashable | None = None) -> Future:
+        """Sends `line` to its worker, the returned future gets the command's result or the exception it raised"""
+        if self._closed:
+            raise RuntimeError("the dispatcher is closed")
+
+        if key is None and self.key is not None and context is not None:
+            key = self.key(context)
+
+        task_id = next(self._ids)
+        future: Future = Future()
+        shard = self.shard_for(key)
+        with self._lock:  # tied to the worker that gets the line, if that one dies the future fails
+            self._futures[task_id] = (self._worker_ids[shard], future)
+            queue = self._queues[shard]
+
+        try:
+            queue.put((task_id, line, context))  # pickles right here, so a bad context raises here
+        except Exception as e:
+            with self._lock:
+                del self._futures[task_id]
+            raise UnpicklableArgument("context", context, e) from e
+
+        return future
+
+    async def dispatch(self, line: str, *, context: Any = None, key: Hashable | None = None) -> Any:
+        return await asyncio.wrap_future(self.submit(line, context=context, key=key))
+
+    def close(self, *, timeout: float | None = None) -> None:
+        """Lets the workers finish what was already submitted and stops them"""
+        with self._lock:  # no worker is replaced from here on
+            if self._closed:
+                return
+            self._closed = True
+
+        for queue in self._queues:
+            queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+
+        self._watch_thread.join(timeout)
+        self._results.put(None)
+        self._result_thread.join(timeout)
+
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        for _, future in futures.values():
+            future.set_exception(RuntimeError("the dispatcher was closed before the command finished"))
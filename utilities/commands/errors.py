@@ -1,15 +1,25 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any
 
 if TYPE_CHECKING:
-    from utilities.commands import Parameter
+    from utilities.commands import Command, Parameter
 
 
 class ConversionError(Exception):
     """An exception raised whenever an error occurs during conversion"""
 
 
+class BulkConversionError(ConversionError):
+    """A ConversionError raised when converting many arguments at once, `index` is the position of the bad one"""
+
+    def __init__(self, index: int, argument: str, error: Exception):
+        self.index = index
+        self.argument = argument
+        self.error = error
+        super().__init__(f"argument {index} ({argument!r}) could not be converted: {error}")
+
+
 class MissingRequiredArgument(Exception):
     """An error raised when there are missing arguments"""
 
@@ -22,3 +32,53 @@ class CommandNotFound(Exception):
 
     def __init__(self, name: str):
         self.name = name
+
+
+class UnpicklableArgument(Exception):
+    """An error raised when a `run_in="process"` command gets an argument that can't be sent to a worker process
+
+    `argument` is the positional index, keyword name or "context". A context object is sent along with the
+    arguments, define `__getstate__` (or `__reduce__`) on it to send only the picklable parts
+    """
+
+    def __init__(self, argument: int | str | None, value: Any, error: Exception | None):
+        self.argument = argument
+        self.value = value
+        self.error = error
+        super().__init__(f"argument {argument!r} ({type(value).__name__}) can't be pickled for a worker process: {error}")
+
+
+class CommandTimeout(TimeoutError):
+    """An error raised when an async command takes longer than its timeout, converters included"""
+
+    def __init__(self, command: Command, timeout: float):
+        self.command = command
+        self.timeout = timeout
+        super().__init__(f"{command.qualified_name} timed out after {timeout}s")
+
+
+class CommandCancelled(Exception):
+    """An error raised when a running invocation is cancelled through `Invocation.cancel`/`cancel_invocation`"""
+
+    def __init__(self, command: Command):
+        self.command = command
+        super().__init__(f"{command.qualified_name} was cancelled")
+
+
+class CommandBusy(Exception):
+    """An error raised when a command with `max_concurrency` is at its limit and `max_queue` invocations are already waiting"""
+
+    def __init__(self, command: Command, bucket: Any, waiting: int):
+        self.command = command
+        self.bucket = bucket
+        self.waiting = waiting
+        super().__init__(f"{command.qualified_name} is busy, {waiting} invocations are already waiting")
+
+
+class WorkerDied(Exception):
+    """An error raised for the commands a ShardedDispatcher worker process had pending when it exited"""
+
+    def __init__(self, shard: int, exitcode: int | None):
+        self.shard = shard
+        self.exitcode = exitcode
+        super().__init__(f"the worker of shard {shard} exited (code {exitcode}) before the command finished")
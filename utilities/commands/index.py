@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import heapq
+from bisect import bisect_left
+from collections import Counter
+from itertools import chain
+from typing import TYPE_CHECKING, Iterable
+
+if TYPE_CHECKING:
+    from utilities.commands import Command
+
+
+class PrefixIndex:
+    """Prefix queries over a fixed set of strings in O(log n + k log k), matches come back in the order they were given"""
+
+    def __init__(self, values: Iterable[str]):
+        self.values: list[str] = list(dict.fromkeys(values))
+        # searched through a sorted copy that remembers where each value was declared
+        self._sorted: list[tuple[str, int]] = sorted((value, position) for position, value in enumerate(self.values))
+        self._keys: list[str] = [value for value, _ in self._sorted]
+
+    def __len__(self):
+        return len(self.values)
+
+    def get_prefixed(self, prefix: str) -> list[str]:
+        values = self.values
+        if not prefix:
+            return values[:]
+
+        keys = self._keys
+        start = bisect_left(keys, prefix)
+        # every string starting with `prefix` sorts before `prefix` with its last character bumped by one
+        end = bisect_left(keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), start) if ord(prefix[-1]) < 0x10FFFF else len(keys)
+        if end - start == 1:
+            return [keys[start]]
+        return [values[position] for position in sorted(position for _, position in self._sorted[start:end])]
+
+
+def _trigrams(string: str, *, complete: bool = True) -> set[str]:
+    # queries are usually still being typed, so they don't get a gram marking the end of the word
+    padded = f" {string.lower()} " if complete else f" {string.lower()}"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class FuzzyIndex:
+    """Typo tolerant completion over a fixed set of candidates
+
+    Candidates are indexed by their trigrams up front, a query only has to count how many trigrams it shares
+    with each candidate through the posting lists and then rank a small shortlist
+    """
+
+    def __init__(self, candidates: Iterable[str]):
+        self.candidates: list[str] = list(dict.fromkeys(candidates))
+        self.prefix_index: PrefixIndex = PrefixIndex(self.candidates)
+        self._gram_counts: list[int] = []
+        self._postings: dict[str, list[int]] = {}
+
+        for candidate_id, candidate in enumerate(self.candidates):
+            grams = _trigrams(candidate)
+            self._gram_counts.append(len(grams))
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(candidate_id)
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def search(self, query: str, *, limit: int = 10) -> list[str]:
+        if len(query) < 3:  # too short for trigrams to say anything, stick to prefixes
+            return self.prefix_index.get_prefixed(query)[:limit]
+
+        query_grams = _trigrams(query, complete=False)
+        postings = [self._postings[gram] for gram in query_grams if gram in self._postings]
+        if not postings:
+            return []
+
+        shared = Counter(chain.from_iterable(postings))
+        shortlist = shared.most_common(limit * 4)
+
+        lowered = query.lower()
+        candidates = self.candidates
+        gram_counts = self._gram_counts
+        query_count = len(query_grams)
+
+        def score(item: tuple[int, int]) -> float:
+            # mostly how much of the query was found, ties go to exact prefixes and then to shorter candidates
+            candidate_id, count = item
+            similarity = count / query_count - gram_counts[candidate_id] / 1000
+            if candidates[candidate_id].lower().startswith(lowered):
+                similarity += 1
+            return similarity
+
+        best = heapq.nlargest(limit, shortlist, key=score)
+        return [candidates[candidate_id] for candidate_id, count in best if count * 3 >= query_count]
+
+
+class CommandIndex:
+    """A name -> Command table kept in sync with an ordered list of commands"""
+
+    def __init__(self):
+        self.commands: list[Command] = []
+        self.names: dict[str, Command] = {}
+        self.version: int = 0
+        self._prefix_index: PrefixIndex | None = None
+        self._fuzzy_index: FuzzyIndex | None = None
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    def __contains__(self, name: str):
+        return name in self.names
+
+    def get(self, name: str) -> Command | None:
+        return self.names.get(name)
+
+    def add(self, command: Command) -> Command:
+        self.commands.append(command)
+        for name in command.names:
+            self.names.setdefault(name, command)  # the first registered command keeps the name, same as a linear scan
+
+        self._invalidate()
+        return command
+
+    def remove(self, command: Command) -> Command:
+        self.commands.remove(command)
+        for name in command.names:
+            if self.names.get(name) is command:
+                del self.names[name]
+
+        # a removed command might have been shadowing an older registration
+        for cmd in self.commands:
+            for name in cmd.names:
+                self.names.setdefault(name, cmd)
+
+        self._invalidate()
+        return command
+
+    def _invalidate(self):
+        self.version += 1
+        self._prefix_index = None
+        self._fuzzy_index = None
+
+    @property
+    def prefix_index(self) -> PrefixIndex:
+        # rebuilt lazily, at most once per version of the index
+        if self._prefix_index is None:
+            self._prefix_index = PrefixIndex(self.names)
+        return self._prefix_index
+
+    @property
+    def fuzzy_index(self) -> FuzzyIndex:
+        if self._fuzzy_index is None:
+            self._fuzzy_index = FuzzyIndex(self.names)
+        return self._fuzzy_index
+
+    def get_prefixed_names(self, prefix: str) -> list[str]:
+        return self.prefix_index.get_prefixed(prefix)
+
+    def get_fuzzy_names(self, query: str, *, limit: int = 10) -> list[str]:
+        return self.fuzzy_index.search(query, limit=limit)
+
+    def resolve_prefix(self, prefix: str) -> Command | None:
+        """Returns the command matching `prefix` if it's an exact name or only one command starts with it"""
+        if command := self.names.get(prefix):
+            return command
+
+        commands = {self.names[name] for name in self.get_prefixed_names(prefix)}
+        if len(commands) == 1:
+            return commands.pop()
+
+        return None
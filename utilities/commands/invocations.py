@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import time
+from typing import TYPE_CHECKING, Any, Awaitable
+
+from utilities.commands.errors import CommandCancelled, CommandTimeout
+
+if TYPE_CHECKING:
+    from utilities.commands import Command
+
+
+_ids = itertools.count(1)
+_invocations: dict[int, Invocation] = {}
+
+
+class Invocation:
+    """An async command invocation that's still running, from `get_invocations`"""
+    __slots__ = ("id", "command", "string", "context", "timeout", "started", "cancelled", "expired", "task")
+
+    def __init__(self, command: Command, string: str, context: Any, timeout: float | None):
+        self.id: int = next(_ids)
+        self.command = command
+        self.string = string
+        self.context = context
+        self.timeout = timeout
+        self.started: float = time.monotonic()
+        self.cancelled: bool = False
+        self.expired: bool = False
+        self.task: asyncio.Task = asyncio.current_task()  # type: ignore
+
+    def __repr__(self):
+        return f"<Invocation id={self.id} command={self.command.qualified_name!r} elapsed={self.elapsed:.3f}>"
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def cancel(self) -> None:
+        """Stops the invocation, it raises CommandCancelled. Safe to call from any thread"""
+        self.task.get_loop().call_soon_threadsafe(self._cancel)
+
+    def _cancel(self):
+        if self.id in _invocations and not (self.cancelled or self.expired):
+            self.cancelled = True
+            self.task.cancel()
+
+    def _expire(self):
+        if self.id in _invocations and not (self.cancelled or self.expired):
+            self.expired = True
+            self.task.cancel()
+
+
+def get_invocations(command: Command | None = None) -> list[Invocation]:
+    """The async invocations running right now (of `command` only if it's given), oldest first"""
+    return [invocation for invocation in _invocations.values() if command is None or invocation.command is command]
+
+
+def cancel_invocation(invocation_id: int) -> bool:
+    try:
+        invocation = _invocations[invocation_id]
+    except KeyError:
+        return False
+
+    invocation.cancel()
+    return True
+
+
+def _uncancel(task: asyncio.Task) -> bool:
+    # takes our cancellation request back, True unless something else asked for one too. Only python 3.11+ counts
+    # requests, before that an outside cancel that arrives at the same time as ours is treated as ours
+    uncancel = getattr(task, "uncancel", None)
+    return uncancel is None or uncancel() == 0
+
+
+async def supervise(command: Command, awaitable: Awaitable, string: str, context: Any) -> Any:
+    # converters and the callback both run under the timeout. Timeouts and `Invocation.cancel` cancel the task like
+    # asyncio.timeout does, only those cancellations turn into CommandTimeout/CommandCancelled, others pass through
+    timeout = command.timeout if command.timeout is not None else command.default_timeout
+    invocation = Invocation(command, string, context, timeout)
+    _invocations[invocation.id] = invocation
+    timer = invocation.task.get_loop().call_later(timeout, invocation._expire) if timeout is not None else None
+    taken_back = False
+
+    try:
+        return await awaitable
+    except asyncio.CancelledError as e:
+        if invocation.expired or invocation.cancelled:
+            taken_back = True
+            if _uncancel(invocation.task):
+                if invocation.expired:
+                    raise CommandTimeout(command, timeout) from e  # type: ignore
+                raise CommandCancelled(command) from e
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+        del _invocations[invocation.id]
+
+        if (invocation.expired or invocation.cancelled) and not taken_back:  # the command swallowed the cancellation
+            _uncancel(invocation.task)
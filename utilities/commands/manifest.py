@@ -0,0 +1,324 @@
+from __future__ import annotations
+
+import functools
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import sys
+from types import UnionType
+from typing import Any, Iterable, Literal, Union
+
+from utilities.commands.command import Command, add_command, get_command_index, get_command_list
+from utilities.commands.converter import FlagConverter, FlagConverterMetaClass
+from utilities.commands.index import CommandIndex
+from utilities.commands.parameter import Parameter
+from utilities.commands.pipeline import PipeInput
+
+MANIFEST_VERSION = 4
+
+_json_types = (str, int, float, bool, type(None))
+
+
+def _dump_annotation(annotation: Any) -> dict[str, Any] | None:
+    # only what completion can use is kept, everything else is loaded as a plain `str` parameter
+    origin = getattr(annotation, "__origin__", None)
+
+    if annotation is PipeInput:
+        return {"pipe": True}
+    elif origin is Literal:
+        if all(isinstance(arg, _json_types) for arg in annotation.__args__):
+            return {"literal": list(annotation.__args__)}
+    elif origin is Union or isinstance(annotation, UnionType):
+        members = [_dump_annotation(arg) for arg in annotation.__args__]
+        if any(members):
+            return {"union": [member or {} for member in members]}
+    elif origin in (list, tuple) and annotation.__args__:
+        if (member := _dump_annotation(annotation.__args__[0])) is not None:
+            return {"list": member}
+    elif inspect.isclass(annotation) and issubclass(annotation, FlagConverter):
+        return {
+            "flags": {
+                "name": annotation.__name__,
+                "prefix": annotation._prefix,  # type: ignore
+                "delimiter": annotation._delimiter,  # type: ignore
+                "flags": {
+                    name: {
+                        "annotation": _dump_annotation(param.annotation),
+                        "required": param.default is inspect.Parameter.empty,
+                    }
+                    for name, param in annotation._flag_parameters.items()  # type: ignore
+                },
+            }
+        }
+
+    return None
+
+
+def _load_annotation(data: dict[str, Any] | None) -> Any:
+    if not data:
+        return str
+
+    if "pipe" in data:
+        return PipeInput
+    elif "literal" in data:
+        return Literal[tuple(data["literal"])]  # type: ignore
+    elif "union" in data:
+        members = tuple(_load_annotation(member) for member in data["union"])
+        return Union[members]  # type: ignore
+    elif "list" in data:
+        return list[_load_annotation(data["list"])]  # type: ignore
+    elif "flags" in data:
+        flags = data["flags"]
+        attrs: dict[str, Any] = {"__annotations__": {}, "__module__": __name__}
+        for name, flag in flags["flags"].items():
+            attrs["__annotations__"][name] = _load_annotation(flag["annotation"])
+            if not flag["required"]:
+                attrs[name] = None  # the real default only matters when converting, which the real class does
+
+        return FlagConverterMetaClass(flags["name"], (FlagConverter,), attrs, prefix=flags["prefix"], delimiter=flags["delimiter"])
+
+    return str
+
+
+def _dump_parameter(param: Parameter) -> dict[str, Any]:
+    data: dict[str, Any] = {"name": param.name, "kind": param.kind.name}
+
+    if param.default is not inspect.Parameter.empty:
+        data["default"] = param.default if isinstance(param.default, _json_types) else repr(param.default)
+    if param.description:
+        data["description"] = param.description
+    if (annotation := _dump_annotation(param.annotation)) is not None:
+        data["annotation"] = annotation
+
+    return data
+
+
+def _load_parameter(data: dict[str, Any]) -> Parameter:
+    return Parameter(
+        name=data["name"],
+        kind=getattr(inspect.Parameter, data["kind"]),
+        default=data.get("default", inspect.Parameter.empty),
+        annotation=_load_annotation(data.get("annotation")),
+        description=data.get("description"),
+    )
+
+
+def _dump_command(command: Command) -> dict[str, Any]:
+    if isinstance(command, ManifestCommand):
+        command = command.load()
+
+    return {
+        "names": command.names,
+        "description": command.description,
+        "usage": command.usage,
+        "module": command.callback.__module__,
+        "qualname": command.callback.__qualname__,
+        "is_async": inspect.iscoroutinefunction(command.callback),
+        "pass_context": command.pass_context,
+        "concurrent_conversion": command.concurrent_conversion,
+        "run_in": command.run_in,
+        "offload_conversion": command.offload_conversion,
+        "timeout": command.timeout,
+        "max_concurrency": command.limiter and command.limiter.max_concurrency,
+        "max_queue": command.limiter and command.limiter.max_queue,
+        "parameters": [_dump_parameter(param) for param in command.parameters],
+        "children": [_dump_command(child) for child in command.children],
+    }
+
+
+def _source_info(module_name: str, *, hash: bool) -> dict[str, Any] | None:
+    path = getattr(sys.modules.get(module_name), "__file__", None)
+    if path is None:
+        return None
+
+    stat = os.stat(path)
+    info: dict[str, Any] = {"path": path, "mtime": stat.st_mtime_ns, "size": stat.st_size}
+    if hash:
+        with open(path, "rb") as f:
+            info["sha256"] = hashlib.sha256(f.read()).hexdigest()
+
+    return info
+
+
+def dump_manifest(path: str | os.PathLike, commands: Iterable[Command] | None = None) -> dict[str, Any]:
+    """Writes the registered commands (or `commands`) to a JSON manifest at `path` and returns it
+
+    Every module a command comes from is recorded with its mtime, size and hash, `load_manifest` uses them to
+    tell when the manifest went stale
+    """
+    entries = [_dump_command(command) for command in (get_command_list() if commands is None else commands)]
+
+    modules: set[str] = set()
+    pending = list(entries)
+    while pending:
+        entry = pending.pop()
+        modules.add(entry["module"])
+        pending.extend(entry["children"])
+
+    sources = {}
+    for module_name in sorted(modules):
+        if (info := _source_info(module_name, hash=True)) is not None:
+            sources[module_name] = info
+
+    manifest = {"version": MANIFEST_VERSION, "sources": sources, "commands": entries}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+
+    return manifest
+
+
+def _is_fresh(sources: dict[str, dict[str, Any]], validate: Literal["mtime", "hash"] | None) -> bool:
+    if validate is None:
+        return True
+
+    for info in sources.values():
+        try:
+            stat = os.stat(info["path"])
+        except OSError:
+            return False
+
+        if stat.st_size != info["size"]:
+            return False
+
+        if validate == "mtime":
+            if stat.st_mtime_ns != info["mtime"]:
+                return False
+        elif stat.st_mtime_ns != info["mtime"]:  # an untouched file can't have changed, only rehash touched ones
+            with open(info["path"], "rb") as f:
+                if hashlib.sha256(f.read()).hexdigest() != info["sha256"]:
+                    return False
+
+    return True
+
+
+def load_manifest(
+        path: str | os.PathLike,
+        *,
+        validate: Literal["mtime", "hash"] | None = "mtime",
+        register: bool = True
+) -> list[ManifestCommand] | None:
+    """Loads the commands from a manifest written by `dump_manifest` without importing their modules
+
+    Returns None if there's no manifest or it's out of date: "mtime" treats any modified source as stale,
+    "hash" only if its contents changed. The commands are added to the registry unless `register` is False
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get("version") != MANIFEST_VERSION or not _is_fresh(manifest["sources"], validate):
+        return None
+
+    commands = [ManifestCommand(entry) for entry in manifest["commands"]]
+    if register:
+        for command in commands:
+            add_command(command)
+
+    return commands
+
+
+def _drop_shadowed(module_name: str) -> None:
+    # importing a command module registers its real commands, the manifest ones already hold those names
+    index = get_command_index()
+    for command in index.commands[:]:
+        if isinstance(command, ManifestCommand) or getattr(command.callback, "__module__", None) != module_name:
+            continue
+
+        if isinstance(index.get(command.names[0]), ManifestCommand):
+            index.remove(command)
+
+
+class ManifestCommand(Command):
+    """A command loaded from a manifest, it can be completed and listed right away
+
+    The module defining it is only imported the first time it's executed (or `load` is called),
+    from then on it runs exactly like the real command
+    """
+
+    def __init__(self, entry: dict[str, Any], *, parent: Command | None = None):
+        self.names: list[str] = entry["names"]
+        self.usage: str = entry["usage"]
+        self.description: str = entry["description"]
+        self.pass_context: bool = entry["pass_context"]
+        self.concurrent_conversion: bool = entry["concurrent_conversion"]
+        self.module: str = entry["module"]
+        self.qualname: str = entry["qualname"]
+        self.is_async: bool = entry["is_async"]
+        self.run_in = entry["run_in"]
+        self.offload_conversion: bool = entry["offload_conversion"]
+        self.executor = None
+        self.timeout: float | None = entry["timeout"]
+        self.max_concurrency: int | None = entry["max_concurrency"]
+        self.max_queue: int | None = entry["max_queue"]
+
+        self.parameters: list[Parameter] = [_load_parameter(param) for param in entry["parameters"]]  # type: ignore
+
+        self.parent: Command | None = parent
+        self.child_index: CommandIndex = CommandIndex()
+        for child in entry["children"]:
+            self.child_index.add(ManifestCommand(child, parent=self))
+
+        if self.is_async:
+            self.execute = self.async_execute
+        elif self.run_in is not None:
+            self.execute = self.offloaded_execute
+        else:
+            self.execute = self.sync_execute
+        self._profile_request = None
+        self._command: Command | None = None
+
+    def __repr__(self):
+        return f'<ManifestCommand name="{self.names[0]}" loaded={self._command is not None}>'
+
+    @property
+    def loaded(self) -> bool:
+        return self._command is not None
+
+    def load(self) -> Command:
+        """Imports the module the command is defined in and returns the real command"""
+        if self._command is not None:
+            return self._command
+
+        found: Any = importlib.import_module(self.module)
+        for attr in self.qualname.split("."):
+            found = getattr(found, attr)
+
+        if isinstance(found, Command):
+            command = found
+        else:
+            command = Command(
+                found,
+                name=self.names[0],
+                aliases=self.names[1:],
+                description=self.description,
+                usage=self.usage,
+                pass_context=self.pass_context,
+                concurrent_conversion=self.concurrent_conversion,
+                run_in=self.run_in,
+                offload_conversion=self.offload_conversion,
+                timeout=self.timeout,
+                max_concurrency=self.max_concurrency,
+                max_queue=self.max_queue,
+            )
+
+        _drop_shadowed(self.module)
+        self._command = command
+        self.parameters = command.parameters  # the real annotations complete better than their manifest copies
+        return command
+
+    @functools.cached_property
+    def callback(self):  # type: ignore
+        return self.load().callback
+
+    @functools.cached_property
+    def limiter(self):  # type: ignore
+        # shared with the real command, a `concurrency_key` can't be stored so only decorated commands keep theirs
+        return self.load().limiter
+
+    @functools.cached_property
+    def _invocation_plan(self):  # type: ignore
+        return self.load()._invocation_plan
@@ -1,12 +1,50 @@
+import asyncio
 import inspect
 from types import UnionType
 from inspect import Parameter as InParam
-from typing import Any, Union, Literal, Annotated
+from typing import Any, Union, Literal, Annotated, AsyncIterator, Awaitable
 
-from utilities.commands.converter import Converter, FlagConverter
+from utilities.commands.converter import Converter, FlagConverter, _setting
+from utilities.commands.index import FuzzyIndex, PrefixIndex
 
 empty = InParam.empty
 
+_literal_indexes: dict[Any, PrefixIndex] = {}
+_literal_fuzzy_indexes: dict[Any, FuzzyIndex] = {}
+
+
+def get_literal_index(annotation: Any) -> PrefixIndex:
+    try:
+        return _literal_indexes[annotation]
+    except KeyError:
+        index = _literal_indexes[annotation] = PrefixIndex(str(arg) for arg in annotation.__args__)
+        return index
+
+
+def get_literal_fuzzy_index(annotation: Any) -> FuzzyIndex:
+    try:
+        return _literal_fuzzy_indexes[annotation]
+    except KeyError:
+        index = _literal_fuzzy_indexes[annotation] = FuzzyIndex(str(arg) for arg in annotation.__args__)
+        return index
+
+
+async def collect_completions(source: Awaitable | AsyncIterator, limit: int | None = None) -> list[str]:
+    if not inspect.isasyncgen(source):
+        return list(await source)[:limit]  # type: ignore
+
+    # async generators are only pulled as far as needed
+    results: list[str] = []
+    try:
+        async for completion in source:
+            if limit is not None and len(results) >= limit:
+                break
+            results.append(completion)
+    finally:
+        await source.aclose()
+
+    return results
+
 
 class Parameter(InParam):
     def __init__(self, name: str, kind: Any, default: Any | InParam.empty = empty, annotation: Any = str, description: str | None = None):
@@ -24,39 +62,59 @@ class Parameter(InParam):
         self.description = description
         self.required = self.default is empty
 
-    def get_completions(self, value: str) -> list[str]:
+    def get_completions(self, value: str, *, pending: list[Awaitable | AsyncIterator] | None = None, fuzzy: bool = False) -> list[str]:
+        # async completion sources are skipped, unless `pending` is passed in which case they're added to it un-awaited.
+        # With `fuzzy`, Literal choices fall back to typo tolerant matches when nothing starts with `value`
         annotation = self.annotation
         if origin := getattr(annotation, "__origin__", None):
-            return self.get_origin_completions(annotation, origin, value)
+            return self.get_origin_completions(annotation, origin, value, pending=pending, fuzzy=fuzzy)
 
         if (inspect.isclass(annotation) and issubclass(annotation, Converter)) or isinstance(annotation, Converter):
-            return self.get_annotation_completions(annotation, value)
+            return self.get_annotation_completions(annotation, value, pending=pending, fuzzy=fuzzy)
 
         return []
 
-    def get_origin_completions(self, annotation, origin, value) -> list[str]:
+    async def get_completions_async(self, value: str, *, limit: int | None = None, fuzzy: bool = False) -> list[str]:
+        """Like `get_completions` but also awaits async completion sources, each source gives at most `limit` results"""
+        pending: list[Awaitable | AsyncIterator] = []
+        completions = self.get_completions(value, pending=pending, fuzzy=fuzzy)[:limit]
+
+        for results in await asyncio.gather(*(collect_completions(source, limit) for source in pending)):
+            completions.extend(results)
+
+        return completions
+
+    def get_origin_completions(self, annotation, origin, value, *, pending=None, fuzzy=False) -> list[str]:
         # only Literal, Union, Annotated are supported
         if origin is Literal:
-            return [str(arg) for arg in annotation.__args__ if str(arg).startswith(value)]
+            completions = get_literal_index(annotation).get_prefixed(value)
+            if fuzzy and not completions:
+                completions = get_literal_fuzzy_index(annotation).search(value)
+            return completions
         elif origin is Union or isinstance(origin, UnionType):
             lst: list[str] = []
             for annotation in annotation.__args__:
                 if origin := getattr(annotation, "__origin__", None):
                     if hasattr(annotation, "__metadata__"):
                         annotation = annotation.__metadata__[0]  # type: ignore
-                        lst.extend(self.get_annotation_completions(annotation, value))
+                        lst.extend(self.get_annotation_completions(annotation, value, pending=pending, fuzzy=fuzzy))
                     else:
-                        lst.extend(self.get_origin_completions(annotation, origin, value))
+                        lst.extend(self.get_origin_completions(annotation, origin, value, pending=pending, fuzzy=fuzzy))
                 else:
-                    lst.extend(self.get_annotation_completions(annotation, value))
+                    lst.extend(self.get_annotation_completions(annotation, value, pending=pending, fuzzy=fuzzy))
             return lst
         else:
             raise Exception("Unsupported origin")
 
-    def get_annotation_completions(self, annotation, value) -> list[str]:
-        func = getattr(annotation, "get_completions", NotImplemented)
+    def get_annotation_completions(self, annotation, value, *, pending=None, fuzzy=False) -> list[str]:
+        func = _setting(annotation, "get_completions") if hasattr(annotation, "get_completions") else NotImplemented
         if func is not NotImplemented:
-            return list(func(annotation, value))  # type: ignore
+            if inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func):
+                if pending is not None:
+                    pending.append(func(value) if inspect.ismethod(func) else func(annotation, value))  # type: ignore
+                return []
+
+            return list(func(value) if inspect.ismethod(func) else func(annotation, value))  # type: ignore
 
         if (inspect.isclass(annotation) and issubclass(annotation, FlagConverter)) or isinstance(annotation, FlagConverter):
             flag_conv = annotation
@@ -82,14 +140,14 @@ class Parameter(InParam):
                     origin = getattr(annotation, "__origin__", None)
 
                 if origin is None:
-                    return self.get_annotation_completions(annotation, value)
+                    return self.get_annotation_completions(annotation, value, pending=pending, fuzzy=fuzzy)
                 elif origin in (list, tuple):
                     annotation = annotation.__args__[0]
                     if origin := getattr(annotation, "__origin__", None):
-                        return self.get_origin_completions(annotation, origin, value)
+                        return self.get_origin_completions(annotation, origin, value, pending=pending, fuzzy=fuzzy)
                 else:
-                    return self.get_origin_completions(annotation, origin, value)
+                    return self.get_origin_completions(annotation, origin, value, pending=pending, fuzzy=fuzzy)
             else:
-                return [name for name in flag_conv._flag_names if name.startswith(latest_flag)]  # type: ignore
+                return flag_conv._flag_index.get_prefixed(latest_flag)  # type: ignore
 
         return []
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+from contextvars import ContextVar
+from inspect import isawaitable
+from typing import Any, AsyncIterator, Iterable, Iterator
+
+from utilities.commands.view import StringView, quote_dict
+
+# the output of the previous stage, for the PipeInput parameter of the command that's being executed
+_pipe_input: ContextVar[Any] = ContextVar("_pipe_input", default=None)
+
+
+class PipeInput:
+    """Annotate a keyword only parameter with this to receive the previous pipeline stage's output as a PipeStream
+
+    The parameter isn't parsed from the command string: `def grep(pattern: str, *, lines: PipeInput)`
+    """
+
+
+def _items(value: Any) -> Iterable:
+    # the items a stage's output stands for, a plain return value is a single item
+    if value is None:
+        return ()
+    if isinstance(value, (str, bytes, bytearray, memoryview, dict)) or not isinstance(value, Iterable):
+        return (value,)
+    return value
+
+
+class PipeStream:
+    """The output of a pipeline stage, pulled lazily one item at a time
+
+    Iterate it with `for` if the stages before it are all sync, or with `async for` which works either way.
+    Generators are only advanced as far as the consumer asks, so items stream through with constant memory
+    """
+
+    def __init__(self, source: Any):
+        self.source = source
+
+    def __repr__(self):
+        return f"<PipeStream source={self.source!r}>"
+
+    def __iter__(self) -> Iterator:
+        if isawaitable(self.source) or hasattr(self.source, "__aiter__"):
+            raise TypeError("the previous stage of the pipeline is async, iterate its output with `async for`")
+        return iter(_items(self.source))
+
+    async def __aiter__(self) -> AsyncIterator:
+        source = self.source
+        if isawaitable(source):
+            source = await source
+
+        if hasattr(source, "__aiter__"):
+            async for item in source:
+                yield item
+        else:
+            for item in _items(source):
+                yield item
+
+
+def split_pipeline(string: str) -> list[str]:
+    """Splits `string` on every `|` that stands on its own, quoted ones and ones inside an argument (`a|b`) are kept"""
+    view = StringView(string)
+    stages = []
+    stage_start = 0
+
+    while True:
+        try:
+            start, end = view.get_next_span()
+        except IndexError:
+            break
+
+        if string[start:end] == "|" and (start == 0 or string[start - 1] not in quote_dict):
+            stages.append(string[stage_start:start].strip(" \n"))
+            stage_start = end
+
+    stages.append(string[stage_start:].strip(" \n"))
+    return stages
+
+
+async def with_pipe_input(awaitable: Any, stream: PipeStream) -> Any:
+    # async commands only parse and call once they're awaited, the input has to be there by then
+    token = _pipe_input.set(stream)
+    try:
+        return await awaitable
+    finally:
+        _pipe_input.reset(token)
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import importlib
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Any, Iterable
+
+from utilities.commands.errors import UnpicklableArgument
+
+_thread_pool: ThreadPoolExecutor | None = None
+_process_pool: ProcessPoolExecutor | None = None
+
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    """The bounded pool `run_in="thread"` commands run in, unless they were given their own executor"""
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(thread_name_prefix="command")
+    return _thread_pool
+
+
+def set_thread_pool(executor: ThreadPoolExecutor | None = None, *, max_workers: int | None = None) -> ThreadPoolExecutor:
+    """Replaces the shared pool, with `executor` or a new pool of `max_workers` threads. The old pool finishes its work in the background"""
+    global _thread_pool
+    old, _thread_pool = _thread_pool, executor or ThreadPoolExecutor(max_workers, thread_name_prefix="command")
+    if old is not None:
+        old.shutdown(wait=False)
+    return _thread_pool
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """The pool `run_in="process"` commands run in, unless they were given their own executor"""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor()
+    return _process_pool
+
+
+def set_process_pool(
+        executor: ProcessPoolExecutor | None = None,
+        *,
+        max_workers: int | None = None,
+        max_tasks_per_child: int | None = None,
+        preload: Iterable[str] = (),
+        warm: bool = True
+) -> ProcessPoolExecutor:
+    """Replaces the shared process pool, with `executor` or a new pool of `max_workers` processes
+
+    Workers are replaced after `max_tasks_per_child` tasks (python 3.11+, it makes the pool use the "spawn"
+    start method), which keeps leaky callbacks in check. Every worker imports the `preload` modules when it
+    starts and with `warm` they're all started right away, so the first commands don't pay for it
+    """
+    global _process_pool
+    if executor is None:
+        kwargs: dict[str, Any] = {"initializer": _preload, "initargs": (tuple(preload),)}
+        if max_tasks_per_child is not None:
+            if sys.version_info < (3, 11):
+                raise ValueError("max_tasks_per_child needs python 3.11 or newer")
+            kwargs["max_tasks_per_child"] = max_tasks_per_child
+        executor = ProcessPoolExecutor(max_workers, **kwargs)
+
+    old, _process_pool = _process_pool, executor
+    if old is not None:
+        old.shutdown(wait=False)
+
+    if warm:
+        warm_process_pool(executor)
+    return executor
+
+
+def warm_process_pool(executor: ProcessPoolExecutor | None = None) -> None:
+    # a submit only starts another worker while none are idle, so a burst of them starts every worker
+    executor = executor or get_process_pool()
+    wait([executor.submit(_ping) for _ in range(executor._max_workers)])  # type: ignore
+
+
+def _ping() -> None:
+    pass
+
+
+def _preload(modules: tuple[str, ...]) -> None:
+    for module in modules:
+        importlib.import_module(module)
+
+
+_callbacks: dict[tuple[str, str], Any] = {}
+
+
+def _resolve_callback(module: str, qualname: str) -> Any:
+    # the module attribute is the Command the decorator returned, not the function itself
+    try:
+        return _callbacks[module, qualname]
+    except KeyError:
+        found: Any = importlib.import_module(module)
+        for attr in qualname.split("."):
+            found = getattr(found, attr)
+
+        callback = _callbacks[module, qualname] = getattr(found, "callback", found)
+        return callback
+
+
+def call_in_worker(module: str, qualname: str, payload: bytes) -> Any:
+    args, kwargs = pickle.loads(payload)
+    return _resolve_callback(module, qualname)(*args, **kwargs)
+
+
+def pickle_arguments(args: list, kwargs: dict, *, has_context: bool) -> bytes:
+    """Pickles converted arguments for a worker process, unpicklable ones raise `UnpicklableArgument` naming them"""
+    try:
+        return pickle.dumps((args, kwargs), pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        pass
+
+    # find the culprit for the error message
+    for index, value in enumerate(args):
+        try:
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            raise UnpicklableArgument("context" if has_context and index == 0 else index, value, e) from e
+
+    for name, value in kwargs.items():
+        try:
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            raise UnpicklableArgument(name, value, e) from e
+
+    raise UnpicklableArgument(None, (args, kwargs), None)
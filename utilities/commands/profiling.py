@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import cProfile
+import os
+import pstats
+import sys
+import time
+from collections import defaultdict
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Generator, Literal
+
+if TYPE_CHECKING:
+    from utilities.commands import Command
+
+
+class StackProfiler:
+    """A tracing profiler that keeps whole call stacks, its output is the collapsed stack format flamegraph tools read
+
+    It has the same `enable`/`disable` interface as `cProfile.Profile`
+    """
+
+    def __init__(self):
+        self.stacks: defaultdict[tuple[str, ...], float] = defaultdict(float)
+        self._stack: list[str] = []
+        self._last: float = 0.0
+
+    @staticmethod
+    def _label(frame, event: str, arg: Any) -> str:
+        if event.startswith("c_"):
+            return f"{getattr(arg, '__module__', None) or 'builtins'}.{getattr(arg, '__qualname__', repr(arg))}"
+
+        code = frame.f_code
+        return f"{code.co_qualname if hasattr(code, 'co_qualname') else code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _trace(self, frame, event: str, arg: Any):
+        now = time.perf_counter()
+        if self._stack:
+            self.stacks[tuple(self._stack)] += now - self._last
+
+        if event in ("call", "c_call"):
+            self._stack.append(self._label(frame, event, arg))
+        elif self._stack:  # return, c_return, c_exception
+            self._stack.pop()
+
+        self._last = time.perf_counter()
+
+    def enable(self):
+        # every resume starts from an empty stack, the resumed frames report themselves as calls again
+        self._stack = []
+        self._last = time.perf_counter()
+        sys.setprofile(self._trace)
+
+    def disable(self):
+        sys.setprofile(None)
+        if self._stack:
+            self.stacks[tuple(self._stack)] += time.perf_counter() - self._last
+        self._stack = []
+
+    def dump_stats(self, path: str | os.PathLike):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, seconds in self.stacks.items():
+                f.write(f"{';'.join(stack)} {max(round(seconds * 1_000_000), 1)}\n")
+
+
+class _ProfiledAwaitable:
+    # Only profiles while the wrapped coroutine is actually running, the time it spends
+    # suspended (and whatever else the event loop runs meanwhile) doesn't end up in the profile
+    def __init__(self, coro: Awaitable, profiler: cProfile.Profile | StackProfiler):
+        self.coro = coro
+        self.profiler = profiler
+
+    def __await__(self) -> Generator[Any, Any, Any]:
+        iterator = self.coro.__await__()
+        value: Any = None
+        error: BaseException | None = None
+
+        while True:
+            self.profiler.enable()
+            try:
+                if error is not None:
+                    yielded = iterator.throw(error)
+                else:
+                    yielded = iterator.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.profiler.disable()
+
+            try:
+                value = yield yielded
+                error = None
+            except BaseException as e:
+                value = None
+                error = e
+
+
+class _Capture:
+    def __init__(self, request: ProfileRequest, number: int):
+        self.request = request
+        self.number = number
+        self.profiler: cProfile.Profile | StackProfiler = self._new_profiler()
+        self._worker_profilers: list[cProfile.Profile | StackProfiler] = []
+
+    def _new_profiler(self) -> cProfile.Profile | StackProfiler:
+        return StackProfiler() if self.request.format == "collapsed" else cProfile.Profile()
+
+    def _merged(self) -> cProfile.Profile | StackProfiler | pstats.Stats:
+        if not self._worker_profilers:
+            return self.profiler
+
+        if isinstance(self.profiler, StackProfiler):
+            for worker_profiler in self._worker_profilers:
+                for stack, seconds in worker_profiler.stacks.items():  # type: ignore
+                    self.profiler.stacks[stack] += seconds
+            return self.profiler
+
+        stats = pstats.Stats()
+        for profiler in (self.profiler, *self._worker_profilers):
+            try:
+                stats.add(profiler)
+            except TypeError:  # it never ran anything
+                pass
+        return stats
+
+    def _save(self):
+        extension = "collapsed" if self.request.format == "collapsed" else "prof"
+        name = self.request.command.qualified_name.replace(" ", "_")
+        path = os.path.join(self.request.directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{self.number}.{extension}")
+
+        self._merged().dump_stats(path)
+        self.request.paths.append(path)
+
+    def in_worker(self, func: Callable) -> Callable:
+        """Wraps `func` to be profiled in the worker thread it runs in, profilers only ever see their own thread"""
+        def run(*args: Any, **kwargs: Any) -> Any:
+            profiler = self._new_profiler()
+            self._worker_profilers.append(profiler)
+            profiler.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.disable()
+
+        return run
+
+    def run(self, func: Callable, *args: Any) -> Any:
+        self.profiler.enable()
+        try:
+            return func(*args)
+        finally:
+            self.profiler.disable()
+            self._save()
+
+    async def run_async(self, coro: Awaitable) -> Any:
+        try:
+            return await _ProfiledAwaitable(coro, self.profiler)
+        finally:
+            self._save()
+
+
+class ProfileRequest:
+    """Captures a profile of the next `count` invocations of `command`
+
+    `format` is either "pstats", files `pstats.Stats`/snakeviz can load, or "collapsed",
+    collapsed stacks for flamegraph.pl/speedscope. The written file paths are collected in `paths`
+    """
+
+    def __init__(
+            self,
+            command: Command,
+            count: int = 1,
+            *,
+            directory: str | os.PathLike = ".",
+            format: Literal["pstats", "collapsed"] = "pstats"
+    ):
+        if format not in ("pstats", "collapsed"):
+            raise ValueError(f"unknown profile format {format!r}")
+
+        self.command = command
+        self.remaining = count
+        self.directory = directory
+        self.format = format
+        self.paths: list[str] = []
+        self._taken = 0
+
+    def __repr__(self):
+        return f"<ProfileRequest command={self.command.qualified_name!r} remaining={self.remaining} format={self.format!r}>"
+
+    def cancel(self) -> None:
+        self.remaining = 0
+        if self.command._profile_request is self:
+            self.command._profile_request = None
+
+    def take(self) -> _Capture | None:
+        if self.remaining <= 0:
+            return None
+
+        self.remaining -= 1
+        self._taken += 1
+        if self.remaining == 0:
+            self.command._profile_request = None
+
+        return _Capture(self, self._taken)
@@ -1,17 +1,35 @@
 import prompt_toolkit  # type: ignore
 
+import asyncio
 import typing
 import inspect
 from types import UnionType
-from contextlib import suppress
 
 from prompt_toolkit.completion import CompleteEvent, Completer, Completion  # type: ignore
 from prompt_toolkit.document import Document  # type: ignore
-from utilities.commands import Command, Converter, FlagConverter, StringView, get_command_list
+from utilities.commands import Command, CommandIndex, Converter, FlagConverter, Parameter, StringView, get_command_index, get_command_list
+from utilities.commands.parameter import collect_completions
+from utilities.commands.pipeline import PipeInput
+from utilities.commands.view import quote_dict
+
+
+_ParseState = typing.Tuple[typing.Optional[Command], typing.Optional[CommandIndex], typing.Optional[int]]  # (command, index to look subcommands up in, parameter index)
 
 
 class CommandCompleter(Completer):
     pos: int = 0
+    fuzzy: bool = False  # fall back to typo tolerant matching when nothing starts with what was typed
+
+    def __init__(self):
+        # parse state of the previous document, so typing at the end only re-parses the last token
+        self._text: str = ""
+        self._version: int = -1
+        self._checkpoints: list[tuple[int, _ParseState]] = []
+        self._stable_until: int = 0
+        self._parameters: dict[Command, list[Parameter]] = {}
+        # the same for finding the pipeline stage being typed: where to resume looking for `|` and where the stage started by then
+        self._document: str = ""
+        self._pipe_resume: tuple[int, int] = (0, 0)
 
     def get_completions(self, document: Document, complete_event: CompleteEvent):
         if not document.text:
@@ -22,70 +40,215 @@ class CommandCompleter(Completer):
         if document.text[-1] == " ":
             return []
 
-        view = StringView(document.text)
+        parsed = self._parse(self._current_stage(document.text))  # only the stage being typed matters
+        if parsed is None:
+            return []
+
+        for completion in self._complete(*parsed):
+            yield Completion(completion, start_position=self.pos)
+
+        return []
 
-        command: Command | None = None
-        last_arg = ""
-        command_list = get_command_list()
+    def _current_stage(self, text: str) -> str:
+        # what follows the last standalone `|`, split the same way as split_pipeline.
+        # When text was only appended the scan resumes at the last token, which could still grow (or stop being a `|`)
+        if len(text) >= len(self._document) and text.startswith(self._document):
+            offset, stage_start = self._pipe_resume
+        else:
+            offset, stage_start = 0, 0
+
+        view = StringView(text)
+        view.current_index = offset
+        resume = (offset, stage_start)
+        quoted = False
+
+        while True:
+            before = view.current_index
+            try:
+                start, end = view.get_next_span()
+            except IndexError:
+                break
+
+            if not quoted:
+                resume = (before, stage_start)
+                quoted = text[start] in quote_dict  # an unterminated quote, closing it changes everything after it
+
+            if text[start:end] == "|" and (start == 0 or text[start - 1] not in quote_dict):
+                stage_start = end
+
+        self._document = text
+        self._pipe_resume = resume
+        return text[stage_start:]
+
+    def _parse(self, text: str) -> tuple[_ParseState, str] | None:
+        command_index = get_command_index()
+        checkpoints = self._checkpoints
+
+        if checkpoints and self._version == command_index.version and len(text) > len(self._text) and text.startswith(self._text):
+            # text was only appended, everything before the last token (or an unterminated quote) still parses the same
+            offset, state = checkpoints.pop()
+            while checkpoints and offset > self._stable_until:
+                offset, state = checkpoints.pop()
+        else:
+            checkpoints.clear()
+            self._parameters.clear()
+            offset, state = 0, (None, command_index, None)
+
+        self._text = text
+        self._version = command_index.version
+        self._stable_until = len(text)
+
+        view = StringView(text)
+        view.current_index = offset
+
+        while state is not None:
+            checkpoints.append((view.current_index, state))
+            param = self._get_parameter(state)
+
+            try:
+                if param is not None and param.kind == inspect.Parameter.KEYWORD_ONLY:
+                    start, end = view.get_rest_span()
+                else:
+                    start, end = view.get_next_span()
+            except IndexError:
+                return None
 
+            token = text[start:end]
+            if view.eof:
+                return state, token
+
+            if text[start] in quote_dict:  # an unterminated quote, closing it later changes how this parses
+                self._stable_until = min(self._stable_until, checkpoints[-1][0])
+
+            state = self._advance(state, token)
+
+        return None
+
+    def _get_parameters(self, command: Command) -> list[Parameter]:
         try:
-            while command is None or command.children:
-                command_dict = {}
-                last_arg = view.get_next_word()
+            return self._parameters[command]
+        except KeyError:
+            params = self._parameters[command] = [
+                param for param in command.parameters[command.pass_context:]
+                if param.kind != inspect.Parameter.VAR_KEYWORD and param.annotation is not PipeInput
+            ]
+            return params
+
+    def _get_parameter(self, state: _ParseState) -> Parameter | None:
+        command, _, param_index = state
+        if param_index is None:
+            return None
+
+        params = self._get_parameters(command)  # type: ignore
+        return params[param_index] if param_index < len(params) else None
+
+    def _advance(self, state: _ParseState, token: str) -> _ParseState | None:
+        command, command_index, param_index = state
+
+        if param_index is None:
+            found = command_index.get(token)  # type: ignore
+            if found is not None:
+                if found.children:
+                    return found, found.child_index, None
+                return found, None, 0
+
+            if command is None:
+                return None
+
+            # not a subcommand, so it's the first argument
+            return self._advance((command, None, 0), token)
+
+        param = self._get_parameter(state)
+        if param is None:
+            return None
+
+        if param.kind == inspect.Parameter.VAR_POSITIONAL:
+            return state
+        return command, None, param_index + 1
+
+    def _complete(self, state: _ParseState, token: str, *, pending: list | None = None) -> list[str]:
+        command, command_index, param_index = state
+        self.pos = -len(token)
+
+        if param_index is None:
+            completions = command_index.get_prefixed_names(token)  # type: ignore
+            if self.fuzzy and not completions:
+                completions = command_index.get_fuzzy_names(token)  # type: ignore
+            if command is not None and (param := self._get_parameter((command, None, 0))):
+                completions = completions + self._complete_parameter(param, token, pending=pending)
+            return completions
+
+        param = self._get_parameter(state)
+        if param is None:
+            return []
 
-                for command_obj in command_list:
-                    for name in command_obj.names:
-                        command_dict[name] = command_obj
+        return self._complete_parameter(param, token, pending=pending)
 
-                _command: Command | None = command_dict.get(last_arg)
-                if _command:
-                    command = _command
+    def _complete_parameter(self, param: Parameter, token: str, *, pending: list | None = None) -> list[str]:
+        completions = param.get_completions(token, pending=pending, fuzzy=self.fuzzy)
+        if (inspect.isclass(param.annotation) and issubclass(param.annotation, FlagConverter)) or isinstance(param.annotation, FlagConverter):
+            flag_conv = param.annotation
+            prefix = flag_conv._prefix or " "  # type: ignore
+            delimiter = flag_conv._delimiter  # type: ignore
 
-                    if command.children:  # type: ignore
-                        command_list = command.children  # type: ignore
-                else:
-                    break
-        except IndexError:
-            pass
-
-        completions = []
-        if command:
-            for child in command.children:
-                for name in child.names:
-                    if name.startswith(last_arg):
-                        completions.append(name)
-
-            # autocomplete_dict = getattr(command, "_autocomplete", {})
-            with suppress(IndexError):
-                # TODO: improve!
-                for param in command.parameters[command.pass_context:]:
-                    if param.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD):
-                        last_arg = view.get_next_word()
-                    elif param.kind == inspect.Parameter.KEYWORD_ONLY:
-                        last_arg = view.get_rest()
-                        if not last_arg:
-                            continue
-
-                    self.pos = -len(last_arg)
-
-                    completions = param.get_completions(last_arg)
-                    if (inspect.isclass(param.annotation) and issubclass(param.annotation, FlagConverter)) or isinstance(param.annotation, FlagConverter):
-                        flag_conv = param.annotation
-                        prefix = flag_conv._prefix or " "  # type: ignore
-                        delimiter = flag_conv._delimiter  # type: ignore
-
-                        flags = last_arg.split(prefix)
-                        latest_flag = flags[-1]
-                        if delimiter in latest_flag:
-                            _, _, value = latest_flag.partition(delimiter)
-                            self.pos = -len(value)
-                        else:
-                            self.pos = -len(latest_flag)
-        elif command_list:
-            self.pos = -len(last_arg)
-            completions = [name for command in command_list for name in command.names if name.startswith(last_arg)]
+            flags = token.split(prefix)
+            latest_flag = flags[-1]
+            if delimiter in latest_flag:
+                _, _, value = latest_flag.partition(delimiter)
+                self.pos = -len(value)
+            else:
+                self.pos = -len(latest_flag)
+
+        return completions
+
+
+class AsyncCommandCompleter(CommandCompleter):
+    """A completer that also awaits async completion sources without blocking the prompt
+
+    A lookup only starts once typing has paused for `debounce` seconds and is cancelled as soon as a
+    newer keystroke comes in, every source contributes at most `max_results` completions
+    """
+
+    def __init__(self, *, debounce: float = 0.1, max_results: int | None = 100):
+        super().__init__()
+        self.debounce = debounce
+        self.max_results = max_results
+        self._task: asyncio.Task | None = None
+
+    async def get_completions_async(self, document: Document, complete_event: CompleteEvent):
+        if self._task is not None:
+            self._task.cancel()
+
+        task = self._task = asyncio.ensure_future(self._lookup(document.text))
+        try:
+            pos, completions = await task
+        except asyncio.CancelledError:
+            if self._task is not task:  # superseded by a newer keystroke
+                return
+            raise
 
         for completion in completions:
-            yield Completion(completion, start_position=self.pos)
+            yield Completion(completion, start_position=pos)
 
-        return []
+    async def _lookup(self, text: str) -> tuple[int, list[str]]:
+        if self.debounce:
+            await asyncio.sleep(self.debounce)
+
+        if not text:
+            return self.pos, [cmd.names[0] for cmd in get_command_list()]
+
+        if text[-1] == " ":
+            return 0, []
+
+        parsed = self._parse(self._current_stage(text))
+        if parsed is None:
+            return 0, []
+
+        pending: list = []
+        completions = self._complete(*parsed, pending=pending)[:self.max_results]
+        pos = self.pos
+
+        for results in await asyncio.gather(*(collect_completions(source, self.max_results) for source in pending)):
+            completions.extend(results)
+
+        return pos, completions
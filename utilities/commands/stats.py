@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+from typing import TYPE_CHECKING, Any
+
+from utilities.commands.converter import ConversionPlan
+from utilities.commands.errors import ConversionError
+from utilities.commands.view import StringView
+from utilities.misc import Tabulate
+
+if TYPE_CHECKING:
+    from utilities.commands import Command, Parameter
+
+
+class Histogram:
+    """Latency histogram with fixed, doubling buckets from 1µs to ~2 minutes"""
+
+    bounds: list[float] = [0.000001 * 2 ** i for i in range(28)]
+
+    def __init__(self):
+        self.counts: list[int] = [0] * (len(self.bounds) + 1)
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent: float) -> float:
+        # upper bound of the bucket the percentile falls in
+        if not self.count:
+            return 0.0
+
+        target = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def snapshot(self) -> dict[str, float]:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.mean,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+# time spent in converters by the current invocation, it's a list so tasks spawned by `asyncio.gather` share it
+_conversion_time: ContextVar[list[float]] = ContextVar("_conversion_time")
+
+
+class _TimedPlan(ConversionPlan):
+    def __init__(self, plan: ConversionPlan, stats: ParameterStats):
+        self.plan = plan
+        self.stats = stats
+        self.consumes_view = plan.consumes_view
+        self.bulk = plan.bulk
+
+    def _record(self, start: float, error: BaseException | None = None):
+        elapsed = perf_counter() - start
+        self.stats.latency.record(elapsed)
+        if isinstance(error, ConversionError):
+            self.stats.conversion_errors += 1
+
+        spent = _conversion_time.get(None)
+        if spent is not None:
+            spent[0] += elapsed
+
+    def convert(self, argument: str, view: StringView, context: Any):
+        start = perf_counter()
+        try:
+            value = self.plan.convert(argument, view, context)
+        except BaseException as e:
+            self._record(start, e)
+            raise
+
+        self._record(start)
+        return value
+
+    def convert_many(self, arguments: list[str], view: StringView, context: Any) -> list:
+        start = perf_counter()
+        try:
+            values = self.plan.convert_many(arguments, view, context)
+        except BaseException as e:
+            self._record(start, e)
+            raise
+
+        self._record(start)
+        return values
+
+    async def async_convert(self, argument: str, view: StringView, context: Any):
+        start = perf_counter()
+        try:
+            value = await self.plan.async_convert(argument, view, context)
+        except BaseException as e:
+            self._record(start, e)
+            raise
+
+        self._record(start)
+        return value
+
+
+class ParameterStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.latency = Histogram()
+        self.conversion_errors: int = 0
+
+    def snapshot(self) -> dict[str, Any]:
+        return {"conversion_errors": self.conversion_errors, **self.latency.snapshot()}
+
+
+class CommandStats:
+    def __init__(self, command: Command):
+        self.name: str = command.qualified_name
+        self.invocations: int = 0
+        self.errors: int = 0
+        self.conversion_errors: int = 0
+
+        self.latency = Histogram()  # the whole invocation
+        self.tokenizing = Histogram()  # argument parsing minus the time spent in converters
+        self.callback = Histogram()
+
+        self.parameters: dict[str, ParameterStats] = {}
+        self.plan: list[tuple[Parameter, ConversionPlan]] = []
+        for param, plan in command._invocation_plan:
+            stats = self.parameters[param.name] = ParameterStats(param.name)
+            self.plan.append((param, _TimedPlan(plan, stats)))
+
+    def start(self) -> list[float]:
+        spent = [0.0]
+        _conversion_time.set(spent)
+        return spent
+
+    def record(self, start: float, parsed: float | None, end: float, spent: list[float], error: BaseException | None = None):
+        self.invocations += 1
+        self.latency.record(end - start)
+
+        if parsed is not None:
+            self.tokenizing.record(max(parsed - start - spent[0], 0.0))
+            self.callback.record(end - parsed)
+
+        if error is not None:
+            self.errors += 1
+            if isinstance(error, ConversionError):
+                self.conversion_errors += 1
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "invocations": self.invocations,
+            "errors": self.errors,
+            "conversion_errors": self.conversion_errors,
+            "latency": self.latency.snapshot(),
+            "tokenizing": self.tokenizing.snapshot(),
+            "callback": self.callback.snapshot(),
+            "parameters": {name: stats.snapshot() for name, stats in self.parameters.items()},
+        }
+
+
+class _Instrumentation:
+    def __init__(self):
+        self.enabled: bool = False
+        self.commands: dict[Command, CommandStats] = {}
+
+    def get(self, command: Command) -> CommandStats:
+        try:
+            return self.commands[command]
+        except KeyError:
+            stats = self.commands[command] = CommandStats(command)
+            return stats
+
+
+instrumentation = _Instrumentation()
+
+
+def enable_stats() -> None:
+    instrumentation.enabled = True
+
+
+def disable_stats() -> None:
+    instrumentation.enabled = False
+
+
+def reset_stats() -> None:
+    instrumentation.commands.clear()
+
+
+def get_stats_snapshot() -> dict[str, dict[str, Any]]:
+    return {stats.name: stats.snapshot() for stats in instrumentation.commands.values()}
+
+
+def format_stats(*, sort_by: str = "total") -> str:
+    """Formats the recorded stats as a table, slowest commands (by `sort_by` of their latency) first"""
+    table = Tabulate(columns=["command", "calls", "errors", "conv errors", "mean ms", "p50 ms", "p99 ms", "max ms", "tokenize ms", "callback ms"])
+
+    def ms(seconds: float) -> str:
+        return f"{seconds * 1000:.3f}"
+
+    rows = sorted(instrumentation.commands.values(), key=lambda stats: stats.latency.snapshot()[sort_by], reverse=True)
+    for stats in rows:
+        latency = stats.latency.snapshot()
+        table.add_row([
+            stats.name, str(stats.invocations), str(stats.errors), str(stats.conversion_errors),
+            ms(latency["mean"]), ms(latency["p50"]), ms(latency["p99"]), ms(latency["max"]),
+            ms(stats.tokenizing.mean), ms(stats.callback.mean),
+        ])
+
+        for param_stats in stats.parameters.values():
+            if param_stats.latency.count:
+                param_latency = param_stats.latency.snapshot()
+                table.add_row([
+                    f"  {param_stats.name}", str(param_stats.latency.count), "", str(param_stats.conversion_errors),
+                    ms(param_latency["mean"]), ms(param_latency["p50"]), ms(param_latency["p99"]), ms(param_latency["max"]),
+                    "", "",
+                ])
+
+    return table.format(format_string=str.ljust)
@@ -1,3 +1,7 @@
+from __future__ import annotations
+
+import re
+
 quote_dict = {
     '"': '"',
     "‘": "’",
@@ -19,57 +23,87 @@ quote_dict = {
 }
 
 
+_whitespace = re.compile(r"[ \n]*")
+_spaces = re.compile(r" *")
+_word_end = re.compile(r"[ \n]")
+_word_separator = re.compile(r"[ \n]+")
+_quotes = re.compile(f"[{re.escape(''.join(quote_dict))}]")
+
+
 class StringView:
     def __init__(self, string: str):
         self.string: str = string
-        self.current_index: str = 0
-        self.temp: str = ""
-        self.should_undo: bool = False
+        self.current_index: int = 0
+        self.last_span: tuple[int, int] | None = None
+        self._token_starts: list[int] = []
 
     @property
     def eof(self):
         return self.current_index >= len(self.string)
 
-    def get_rest(self):
-        if self.should_undo:
-            word = f"{self.temp}{self.string[self.current_index:]}"
-        else:
-            word = self.string[self.current_index:].lstrip(" ")
-        self.current_index = len(self.string)
-        return word
+    def checkpoint(self) -> int:
+        return self.current_index
+
+    def rewind(self, checkpoint: int):
+        starts = self._token_starts
+        while starts and starts[-1] >= checkpoint:
+            starts.pop()
+
+        self.current_index = checkpoint
 
     def undo(self):
-        self.should_undo = True
+        # steps back over the last read token, can be called repeatedly to keep going back
+        if self._token_starts:
+            self.current_index = self._token_starts.pop()
 
-    def get_next_word(self):
-        if self.should_undo is True:
-            self.should_undo = False
-            return self.temp
+    def get_rest_span(self) -> tuple[int, int]:
+        start = _spaces.match(self.string, self.current_index).end()  # type: ignore
+        end = len(self.string)
+
+        self._token_starts.append(self.current_index)
+        self.current_index = end
+        self.last_span = (start, end)
+        return start, end
 
-        while self.string[self.current_index] in [" ", "\n"]:
-            self.current_index += 1
+    def get_rest(self):
+        start, end = self.get_rest_span()
+        return self.string[start:end]
+
+    def get_rest_words(self) -> list[str] | None:
+        # reads every remaining word in one go, returns None without moving if there are quotes to take care of
+        rest = self.string[self.current_index:]
+        if _quotes.search(rest):
+            return None
+
+        self._token_starts.append(self.current_index)
+        self.current_index = len(self.string)
+        self.last_span = (len(self.string) - len(rest), len(self.string))
+
+        rest = rest.strip(" \n")
+        return _word_separator.split(rest) if rest else []
 
-        char = self.string[self.current_index]
+    def get_next_span(self) -> tuple[int, int]:
+        string = self.string
+        start = _whitespace.match(string, self.current_index).end()  # type: ignore
+
+        char = string[start]  # raises IndexError when there's nothing left to read
 
         if char in quote_dict:
-            next_quote = quote_dict[char]
-            remaining = self.string[self.current_index + 1:]
-            if next_quote in remaining:
-                index = self.string.index(next_quote, self.current_index + 1)
-                word = self.string[self.current_index + 1:index]
-                self.current_index = index + 1
-
-                self.temp = word
-                return word
-
-        word = ""
-        while char not in [" ", "\n"]:
-            try:
-                word += char
-                self.current_index += 1
-                char = self.string[self.current_index]
-            except IndexError:
-                break
-
-        self.temp = word
-        return word
+            end = string.find(quote_dict[char], start + 1)
+            if end != -1:
+                self._token_starts.append(self.current_index)
+                self.current_index = end + 1
+                self.last_span = (start + 1, end)
+                return start + 1, end
+
+        match = _word_end.search(string, start)
+        end = match.start() if match else len(string)
+
+        self._token_starts.append(self.current_index)
+        self.current_index = end
+        self.last_span = (start, end)
+        return start, end
+
+    def get_next_word(self):
+        start, end = self.get_next_span()
+        return self.string[start:end]
@@ -2,6 +2,8 @@ from __future__ import annotations
 import asyncio
 import functools
 import typing
+import contextvars
+from concurrent.futures import Executor, ProcessPoolExecutor
 from inspect import isawaitable
 from typing import Optional, Iterable
 
@@ -40,11 +42,18 @@ class TableFormat:
     VERTICAL = "\u2503"
 
 
-def run_in_executor(func):
+def run_in_executor(func=None, *, executor: Executor | None = None):
+    # works as `@run_in_executor` (the loop's default executor) and as `@run_in_executor(executor=pool)`
+    if func is None:
+        return functools.partial(run_in_executor, executor=executor)
+
+    @functools.wraps(func)
     async def wrapper(*args, **kwargs):
         loop = asyncio.get_event_loop()
         f = functools.partial(func, *args, **kwargs)
-        out = await loop.run_in_executor(None, f)
+        if not isinstance(executor, ProcessPoolExecutor):
+            f = functools.partial(contextvars.copy_context().run, f)  # like asyncio.to_thread, context variables carry over
+        out = await loop.run_in_executor(executor, f)
         if isawaitable(out):
             return await out
         else: